@@ -0,0 +1,125 @@
+# Dynamic micro-batching for the socket server.
+# Jobs that arrive within a short window are grouped (up to max_batch) and run through
+# one padded llm.polish_batch call on the inference executor; each caller then gets
+# its own decoded answer back. Under load the window matters less: while every
+# executor thread is busy the queue keeps growing, and the next free thread takes
+# the largest batch it can.
+#
+# run_batch(jobs, queue_depth=n) is told how many jobs are still waiting, so generation
+# can trade beams for throughput when the queue is long.
+import asyncio
+import functools
+import time
+from collections import Counter, deque
+
+from metrics import METRICS
+
+
+class MicroBatcher:
+    def __init__(self, run_batch, executor, max_batch: int = 8, max_wait: float = 0.025, parallel: int = 1):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self._queue = deque()
+        self._arrived = None
+        self._slots = None
+        self._parallel = max(1, parallel)
+        # statistics exposed through the "stats" socket message
+        self.batches = 0
+        self.items = 0
+        self.batch_sizes = Counter()
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        # queued jobs whose callers gave up (client disconnected) before their batch started
+        self.dropped = 0
+        # running average of how long one batch takes, for expected_wait
+        self.batch_seconds = None
+
+    async def submit(self, job):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((job, future, time.monotonic()))
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        self._arrived.set()
+        return await future
+
+    async def run(self):
+        self._arrived = asyncio.Event()
+        self._slots = asyncio.Semaphore(self._parallel)
+        while True:
+            await self._slots.acquire()
+            while not self._queue:
+                self._arrived.clear()
+                await self._arrived.wait()
+            # give other requests until max_wait after the oldest one arrived to join the batch
+            while len(self._queue) < self.max_batch:
+                remaining = self._queue[0][2] + self.max_wait - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        # callers that gave up while waiting do not need an answer
+        live = [entry for entry in batch if not entry[1].done()]
+        self.dropped += len(batch) - len(live)
+        batch = live
+        try:
+            if not batch:
+                return
+            now = time.monotonic()
+            self.batches += 1
+            self.items += len(batch)
+            self.batch_sizes[len(batch)] += 1
+            self.total_wait += sum(now - queued_at for _, _, queued_at in batch)
+            for _, _, queued_at in batch:
+                METRICS.observe("chatbot_queue_wait_seconds", now - queued_at)
+            loop = asyncio.get_running_loop()
+            try:
+                run = functools.partial(self.run_batch, [job for job, _, _ in batch], queue_depth=len(self._queue))
+                results = await loop.run_in_executor(self.executor, run)
+                elapsed = time.monotonic() - now
+                self.batch_seconds = elapsed if self.batch_seconds is None else 0.8 * self.batch_seconds + 0.2 * elapsed
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def expected_wait(self, ahead: int) -> float:
+        # seconds until a job with `ahead` jobs in front of it is answered, if the next
+        # batches take as long as the recent ones (0 until the first batch has run)
+        if self.batch_seconds is None:
+            return 0.0
+        rounds = ahead // self.max_batch // self._parallel + 1
+        return rounds * self.batch_seconds
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self._queue),
+            "max_queue_depth": self.max_queue_depth,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0,
+            "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            "avg_queue_wait_ms": round(1000 * self.total_wait / self.items, 1) if self.items else 0,
+            "max_batch": self.max_batch,
+            "max_wait_ms": round(1000 * self.max_wait, 1),
+            "avg_batch_ms": round(1000 * self.batch_seconds, 1) if self.batch_seconds is not None else None,
+        }
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Compares the FAISS index types of vector_index.py on the ingested chunks: recall@k against
+# exact (flat) search, query latency and index size, for a range of search settings. Use it
+# to pick FAISS_INDEX_TYPE for ingest.py and FAISS_NPROBE / FAISS_EF_SEARCH for the server.
+#
+#   python bench_index.py                                  # all types on faiss_index/
+#   python bench_index.py --types hnsw,ivf_pq --k 5 --out index_bench.json
+#   python bench_index.py --questions questions.json       # real questions as queries
+#
+# The chunk vectors come from the saved index (re-embedded from the docstore when it is not
+# a flat index). Queries are the embedded --questions, or --queries chunk vectors sampled
+# with a fixed seed. Latency is measured one query at a time, like the server searches.
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+
+import faiss
+import numpy as np
+
+from metrics import percentile
+from questions import read_questions
+from vector_index import INDEX_TYPES, build_index, default_nlist, index_bytes, set_search_params
+
+NPROBES = (1, 4, 16, 64)
+EF_SEARCHES = (16, 32, 64, 128)
+
+
+def load_vectors(directory: str):
+    index = faiss.read_index(os.path.join(directory, "index.faiss"))
+    if isinstance(index, faiss.IndexFlat):
+        return index.reconstruct_n(0, index.ntotal)
+    # approximate indexes do not keep the exact vectors, embed the chunks again in row order
+    from model_registry import get_embeddings
+    with open(os.path.join(directory, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    texts = [docstore.search(index_to_docstore_id[row]).page_content for row in range(index.ntotal)]
+    print(f"Re-embedding {len(texts)} chunks...")
+    return np.asarray(get_embeddings().embed_documents(texts), dtype="float32")
+
+
+def load_queries(path: str, vectors, count: int, seed: int):
+    if not path:
+        rows = np.random.default_rng(seed).choice(len(vectors), min(count, len(vectors)), replace=False)
+        return vectors[rows]
+    questions = list(dict.fromkeys(read_questions(path)))[:count]
+    from model_registry import get_embeddings
+    embeddings = get_embeddings()
+    return np.asarray([embeddings.embed_query(q) for q in questions], dtype="float32")
+
+
+def recall(found, truth) -> float:
+    # share of the exact top k that the index also returned
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def measure(index, queries, truth, k: int) -> dict:
+    found = []
+    latencies = []
+    for q in queries:
+        started = time.perf_counter()
+        _, rows = index.search(q.reshape(1, -1), k)
+        latencies.append(1000 * (time.perf_counter() - started))
+        found.append(rows[0])
+    return {
+        f"recall@{k}": round(recall(np.array(found), truth), 4),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+    }
+
+
+def settings(index_type: str):
+    # (label, nprobe, efSearch) of the search settings worth comparing
+    if index_type == "hnsw":
+        return [(f"efSearch {ef}", 0, ef) for ef in EF_SEARCHES]
+    if index_type.startswith("ivf"):
+        return [(f"nprobe {n}", n, 0) for n in NPROBES]
+    return [("exact", 0, 0)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FAISS index types on the ingested chunks")
+    parser.add_argument("--index", default=os.environ.get("FAISS_INDEX_DIR", "faiss_index"),
+                        help="directory written by ingest.py")
+    parser.add_argument("--types", default=",".join(INDEX_TYPES), help="index types to compare")
+    parser.add_argument("--k", type=int, default=5, help="neighbours per query for recall@k")
+    parser.add_argument("--questions", help="JSON list or JSON lines of questions to use as queries")
+    parser.add_argument("--queries", type=int, default=500, help="number of queries")
+    parser.add_argument("--nlist", type=int, default=0, help="IVF clusters, 0 = about 4 * sqrt(chunks)")
+    parser.add_argument("--hnsw-m", type=int, default=32, help="HNSW neighbours per node")
+    parser.add_argument("--pq-m", type=int, default=16, help="PQ sub-vectors")
+    parser.add_argument("--train-sample", type=int, default=50000, help="vectors IVF clusters are trained on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results as JSON")
+    args = parser.parse_args()
+
+    types = args.types.split(",")
+    unknown = [t for t in types if t not in INDEX_TYPES]
+    if unknown:
+        parser.error(f"unknown index types {', '.join(unknown)}, expected {', '.join(INDEX_TYPES)}")
+    if not os.path.exists(os.path.join(args.index, "index.faiss")):
+        print(f"No FAISS index in {args.index}, run ingest.py first.")
+        sys.exit(1)
+
+    vectors = load_vectors(args.index)
+    queries = load_queries(args.questions, vectors, args.queries, args.seed)
+    k = min(args.k, len(vectors))
+    print(f"{len(vectors)} chunks of dimension {vectors.shape[1]}, {len(queries)} queries, "
+          f"nlist {args.nlist or default_nlist(len(vectors))}")
+
+    # the exact answer every type is measured against
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    results = []
+    print(f"{'type':10s} {'setting':14s} {'recall@' + str(k):>9s} {'p50 ms':>8s} {'p95 ms':>8s} "
+          f"{'size MB':>8s} {'build s':>8s}")
+    for index_type in types:
+        started = time.perf_counter()
+        index = build_index(vectors, index_type, nlist=args.nlist, hnsw_m=args.hnsw_m, pq_m=args.pq_m,
+                            train_sample=args.train_sample, seed=args.seed)
+        build_seconds = time.perf_counter() - started
+        size_mb = index_bytes(index) / 1e6
+        for label, nprobe, ef_search in settings(index_type):
+            set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+            result = {"type": index_type, "setting": label, "nprobe": nprobe, "ef_search": ef_search,
+                      **measure(index, queries, truth, k),
+                      "size_mb": round(size_mb, 2), "build_seconds": round(build_seconds, 2)}
+            results.append(result)
+            print(f"{index_type:10s} {label:14s} {result[f'recall@{k}']:9.4f} {result['p50_ms']:8.3f} "
+                  f"{result['p95_ms']:8.3f} {size_mb:8.2f} {build_seconds:8.2f}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "config": {"index": args.index, "chunks": len(vectors), "dimension": int(vectors.shape[1]),
+                           "queries": len(queries), "k": k, "questions": args.questions,
+                           "nlist": args.nlist or default_nlist(len(vectors))},
+                "results": results,
+            }, f, indent=2)
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
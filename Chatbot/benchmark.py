@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# Benchmarks the chatbot before a change is deployed: latency percentiles, throughput,
+# peak RSS and where the time goes per stage (embed, search, generate, ...).
+#
+#   python benchmark.py --stub                           # offline stand-in models and fixture index
+#   python benchmark.py --target server --stub --concurrency 8
+#   python benchmark.py --target server --address localhost:12345   # a server that is already running
+#   python benchmark.py --stub --out new.json --baseline old.json --max-regression 0.10
+#
+# --target direct calls llm.generate_reply from --concurrency threads; --target server
+# starts the socket server inside this process (or uses --address) and asks through a
+# ClientPool, so batching, coalescing and admission control are part of the numbers.
+# Questions come from --questions (a JSON list, JSON lines with a "question" field, or a query journal)
+# or from a built-in set sampled with a fixed seed. Results are written as JSON; with
+# --baseline the run fails (exit 1) if p50/p95/p99 or throughput are more than
+# --max-regression worse than the baseline's.
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import peak_rss_mb, percentile
+from protocol import CircuitBreaker, ClientPool, ServerBusy
+from questions import QUESTIONS, read_questions
+
+# lower is better for these, higher is better for throughput
+GATED_LATENCIES = ("p50", "p95", "p99")
+
+
+def load_questions(path: str, count: int, seed: int):
+    questions = read_questions(path) if path else QUESTIONS
+    # repeats are part of real traffic, they exercise the caches and coalescing
+    rng = random.Random(seed)
+    return [rng.choice(questions) for _ in range(count)]
+
+
+def setup_stub(index_dir: str):
+    # must run before model_registry is imported, it reads these at import time
+    os.environ["LLM_BACKEND"] = "stub"
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    if not index_dir:
+        index_dir = os.path.join(tempfile.mkdtemp(prefix="ncdb-bench-"), "faiss_index")
+    os.environ["FAISS_INDEX_DIR"] = index_dir
+    if not os.path.exists(os.path.join(index_dir, "index.faiss")):
+        from stub_models import build_fixture_index
+        build_fixture_index(index_dir)
+    return index_dir
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_server():
+    # in this process rather than as a subprocess: get_llm_answer.py's __main__ stops every
+    # other get_llm_answer.py on the host, which must not happen to a production server
+    import asyncio
+    port = free_port()
+    os.environ["CHATBOT_PORT"] = str(port)
+    os.environ["CHATBOT_SOCKET"] = ""
+    os.environ["CHATBOT_METRICS_PORT"] = "0"
+    # benchmark traffic must not end up in the production journal replay.py reads
+    os.environ["CHATBOT_JOURNAL"] = ""
+    import get_llm_answer
+    get_llm_answer.warm_up()
+    sockets = get_llm_answer.bind_sockets()
+    threading.Thread(target=lambda: asyncio.run(get_llm_answer.serve_async(sockets)), daemon=True).start()
+    return ("localhost", port)
+
+
+def stage_breakdown(before: dict, after: dict) -> dict:
+    # per-stage time of this run only: the difference of two metrics snapshots
+    stages = {}
+    old = before.get("histograms", {}).get("chatbot_stage_seconds", {})
+    for labels, h in after.get("histograms", {}).get("chatbot_stage_seconds", {}).items():
+        prev = old.get(labels, {"count": 0, "sum": 0})
+        count = h["count"] - prev["count"]
+        if count:
+            total = h["sum"] - prev["sum"]
+            stages[labels.replace("stage=", "")] = {"count": count, "total_s": round(total, 3),
+                                                    "avg_ms": round(1000 * total / count, 2)}
+    return stages
+
+
+def counter_delta(before: dict, after: dict, name: str) -> dict:
+    old = before.get("counters", {}).get(name, {})
+    return {labels: value - old.get(labels, 0)
+            for labels, value in after.get("counters", {}).get(name, {}).items() if value - old.get(labels, 0)}
+
+
+def run(args) -> dict:
+    if args.stub:
+        setup_stub(args.index)
+    if args.no_cache:
+        os.environ["ANSWER_CACHE_SIZE"] = "0"
+        os.environ["SEMANTIC_CACHE_SIZE"] = "0"
+    os.environ["ANSWER_CACHE_FILE"] = ""
+
+    questions = load_questions(args.questions, args.requests, args.seed)
+    if args.target == "direct":
+        import llm
+        import model_registry
+        from metrics import METRICS
+        model_registry.warm_up()
+
+        def ask(q):
+            return llm.generate_reply(q, db=model_registry.get_index())
+        snapshot = METRICS.snapshot
+    else:
+        address = args.address or start_server()
+        # the default breaker would fail requests at once after a few timeouts, without
+        # them reaching the server; a benchmark has to measure every one
+        pool = ClientPool(address, size=args.concurrency, timeout=args.timeout,
+                          breaker=CircuitBreaker(failures=10 ** 9))
+
+        def ask(q):
+            return pool.ask(q)
+
+        def snapshot():
+            with pool.client() as client:
+                return client.metrics()
+
+    for q in questions[:args.warmup]:
+        ask(q)
+
+    latencies, errors, busy = [], 0, 0
+    lock = threading.Lock()
+
+    def one(q):
+        nonlocal errors, busy
+        started = time.perf_counter()
+        try:
+            ask(q)
+        except ServerBusy:
+            with lock:
+                busy += 1
+            return
+        except Exception:
+            with lock:
+                errors += 1
+            return
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    before = snapshot()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, questions))
+    wall = time.perf_counter() - started
+    after = snapshot()
+
+    ms = [1000 * x for x in latencies] or [0.0]
+    return {
+        "config": {
+            "target": args.target,
+            "address": args.address or None,
+            "stub": args.stub,
+            "requests": len(questions),
+            "concurrency": args.concurrency,
+            "caches": not args.no_cache,
+            "questions": args.questions or "built-in",
+            "seed": args.seed,
+        },
+        "completed": len(latencies),
+        "errors": errors,
+        "busy": busy,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0,
+        "latency_ms": {
+            "mean": round(sum(ms) / len(ms), 2),
+            "p50": round(percentile(ms, 50), 2),
+            "p95": round(percentile(ms, 95), 2),
+            "p99": round(percentile(ms, 99), 2),
+            "max": round(max(ms), 2),
+        },
+        # with --address the models live in another process, this is only the client
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "stages": stage_breakdown(before, after),
+        "outcomes": counter_delta(before, after, "chatbot_answers_total"),
+    }
+
+
+def check_regression(result: dict, baseline: dict, threshold: float) -> list:
+    failures = []
+    for key in GATED_LATENCIES:
+        old, new = baseline["latency_ms"][key], result["latency_ms"][key]
+        if old and new > old * (1 + threshold):
+            failures.append(f"latency {key} {new} ms vs {old} ms (+{100 * (new / old - 1):.0f}%)")
+    old, new = baseline["throughput_rps"], result["throughput_rps"]
+    if old and new < old * (1 - threshold):
+        failures.append(f"throughput {new} vs {old} req/s ({100 * (new / old - 1):.0f}%)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot")
+    parser.add_argument("--target", choices=["direct", "server"], default="direct")
+    parser.add_argument("--address", help="host:port or unix socket of a running server (default: start one here)")
+    parser.add_argument("--stub", action="store_true", help="tiny offline stand-in models and a fixture index")
+    parser.add_argument("--index", help="FAISS index directory for --stub (default: build a fixture in a temp dir)")
+    parser.add_argument("--questions", help="JSON list or JSON lines of questions (default: built-in set)")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=3, help="untimed requests before the run")
+    parser.add_argument("--timeout", type=float, default=60, help="client timeout per request in server mode")
+    parser.add_argument("--no-cache", action="store_true", help="turn the answer and semantic caches off")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--baseline", help="earlier benchmark JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="allowed relative slowdown against --baseline (default 0.10)")
+    args = parser.parse_args()
+
+    result = run(args)
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+
+    lat = result["latency_ms"]
+    print(f"{result['completed']} answered, {result['busy']} busy, {result['errors']} errors in {result['wall_seconds']} s "
+          f"({result['throughput_rps']} req/s), latency p50 {lat['p50']} ms p95 {lat['p95']} ms p99 {lat['p99']} ms, "
+          f"peak RSS {result['peak_rss_mb']} MB")
+    for stage, s in sorted(result["stages"].items(), key=lambda item: -item[1]["total_s"]):
+        print(f"  {stage:15s} {s['count']:6d} x {s['avg_ms']:8.2f} ms = {s['total_s']:.2f} s")
+    print(f"Results written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = check_regression(result, baseline, args.max_regression)
+        if failures:
+            print(f"Regression beyond {args.max_regression:.0%} against {args.baseline}:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        print(f"No regression beyond {args.max_regression:.0%} against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Lexical (BM25) index over the same chunks as the FAISS index. MiniLM embeddings match
+# engine numbers, body numbers and coachbuilder names ("4302", "Fleetwood") poorly; exact
+# terms are what an inverted index is good at. llm.py fuses both rankings.
+#
+# ingest.py builds it and saves bm25.pkl next to index.faiss; rows are FAISS rows, so a hit
+# maps to its document through db.index_to_docstore_id. Every posting stores its complete
+# BM25 weight, computed at build time, so a query only adds up floats from a few arrays.
+import heapq
+import math
+import os
+import pickle
+import re
+from array import array
+from collections import Counter
+
+BM25_FILE = "bm25.pkl"
+# terms found in more than this share of the chunks carry almost no weight and have the
+# longest posting lists, queries skip them
+MAX_DF_RATIO = 0.5
+
+
+def tokenize(text: str) -> list:
+    # "V-16", "V 16" and "v16" are one term, numbers are kept as terms
+    # only "v": "a 1930" or "a 452" has to stay two terms
+    text = re.sub(r"\bv[- ](\d+)\b", r"v\1", (text or "").lower())
+    return re.findall(r"\w+", text)
+
+
+def _idf(n: int, df: int) -> float:
+    # Lucene's idf, which stays positive for common terms
+    return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+
+class BM25Index:
+    def __init__(self, postings: dict, doc_count: int):
+        # term -> (array of rows, array of weights)
+        self.postings = postings
+        self.doc_count = doc_count
+
+    @classmethod
+    def build(cls, texts, k1: float = 1.2, b: float = 0.75):
+        counts = [Counter(tokenize(text)) for text in texts]
+        lengths = [sum(c.values()) for c in counts]
+        avg_length = (sum(lengths) / len(lengths)) if lengths else 1.0
+        df = Counter(term for c in counts for term in c)
+        n = len(texts)
+        postings = {}
+        for row, (c, length) in enumerate(zip(counts, lengths)):
+            norm = k1 * (1 - b + b * length / (avg_length or 1.0))
+            for term, tf in c.items():
+                idf = _idf(n, df[term])
+                if term not in postings:
+                    postings[term] = (array("I"), array("f"))
+                rows, weights = postings[term]
+                rows.append(row)
+                weights.append(idf * tf * (k1 + 1) / (tf + norm))
+        return cls(postings, n)
+
+    def search(self, query: str, k: int):
+        # [(row, score)] of the k best-matching chunks
+        scores = {}
+        limit = MAX_DF_RATIO * self.doc_count
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None or len(posting[0]) > limit:
+                continue
+            rows, weights = posting
+            for row, weight in zip(rows, weights):
+                scores[row] = scores.get(row, 0.0) + weight
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, directory: str):
+        # renamed into place, so the server never reads half a file
+        path = os.path.join(directory, BM25_FILE)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump({"doc_count": self.doc_count, "postings": self.postings}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, directory: str):
+        # None when the index was ingested before BM25 existed, retrieval is then dense only
+        path = os.path.join(directory, BM25_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        return cls(data["postings"], data["doc_count"])
@@ -0,0 +1,237 @@
+# Answer caches used by llm.generate_reply.
+import atexit
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_question(q: str) -> str:
+    # questions that differ only in case, punctuation or spacing share one cache entry
+    q = (q or "").lower()
+    q = re.sub(r"[^\w\s]", " ", q)
+    return re.sub(r"\s+", " ", q).strip()
+
+
+class AnswerCache:
+    """Bounded LRU cache with a time-to-live, optionally saved to a JSON file."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 86400, path: str = "", save_every: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._save_every = save_every
+        self._saver_pid = None
+        if path:
+            self.load()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._dirty = True
+            if self.path and self._saver_pid != os.getpid():
+                # written from a background thread so a save never delays an answer;
+                # started lazily because threads do not survive the server forking its workers.
+                # Only processes that answer questions save: the pre-fork parent would write
+                # back the stale copy it loaded at startup
+                self._saver_pid = os.getpid()
+                threading.Thread(target=self._autosave, args=(self._save_every,), daemon=True).start()
+                atexit.register(self.flush)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read answer cache {self.path}: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for key, value, stored_at in saved[-self.maxsize:]:
+                if now - stored_at <= self.ttl:
+                    self._entries[key] = (value, stored_at)
+
+    def save(self):
+        with self._lock:
+            entries = {key: (value, stored_at) for key, (value, stored_at) in self._entries.items()}
+            self._dirty = False
+        # worker processes share the file: each one merges its entries into what the others
+        # saved (the newer answer wins), under a lock so no worker's save is lost
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for key, value, stored_at in json.load(f):
+                        if key not in entries or entries[key][1] < stored_at:
+                            entries[key] = (value, stored_at)
+            except (OSError, ValueError):
+                pass
+            now = time.time()
+            merged = sorted(([key, value, stored_at] for key, (value, stored_at) in entries.items()
+                             if now - stored_at <= self.ttl), key=lambda entry: entry[2])[-self.maxsize:]
+            # write to a temp file first so a crash never leaves half a cache behind
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(merged, f)
+            os.replace(tmp_path, self.path)
+
+    def flush(self):
+        # the final save of a process that answered questions, at exit
+        if self.path and self._saver_pid == os.getpid() and self._dirty:
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Warning: could not save answer cache {self.path}: {e}")
+
+    def _autosave(self, interval):
+        while True:
+            time.sleep(interval)
+            if self._dirty:
+                try:
+                    self.save()
+                except OSError as e:
+                    print(f"Warning: could not save answer cache {self.path}: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+        }
+
+
+class SemanticCache:
+    """Small in-memory cache of (query embedding, answer) pairs.
+
+    A new query whose cosine similarity to a cached query reaches the threshold gets
+    that answer back, so paraphrases skip both retrieval and generation. The two questions
+    must also name the same numbers: MiniLM puts "built in 1930" and "built in 1933" (or two
+    engine numbers) almost on top of each other. Entries are dropped least-recently-used
+    first, and all of them go when the index changes.
+    """
+
+    def __init__(self, capacity: int = 512, threshold: float = 0.92):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._index_id = None
+        self._vectors = None
+        self._answers = []
+        self._numbers = []
+        self._last_used = None
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def _check_index(self, index_id):
+        if index_id != self._index_id:
+            self._index_id = index_id
+            self._vectors = None
+            self._answers = []
+            self._numbers = []
+
+    @staticmethod
+    def _question_numbers(question: str) -> tuple:
+        # years, engine and body numbers; "V-16" and "V16" both give 16
+        return tuple(sorted(set(re.findall(r"\d+", question or ""))))
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, vector, index_id, question: str = ""):
+        if self.capacity <= 0:
+            return None
+        vector = self._normalize(vector)
+        numbers = self._question_numbers(question)
+        with self._lock:
+            self._check_index(index_id)
+            if not self._answers:
+                self.misses += 1
+                return None
+            count = len(self._answers)
+            similarities = self._vectors[:count] @ vector
+            similarities[[n != numbers for n in self._numbers]] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self._clock += 1
+            self._last_used[best] = self._clock
+            self.hits += 1
+            return self._answers[best]
+
+    def put(self, vector, index_id, answer, question: str = ""):
+        if self.capacity <= 0:
+            return
+        vector = self._normalize(vector)
+        with self._lock:
+            self._check_index(index_id)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+                self._last_used = np.zeros(self.capacity, dtype=np.int64)
+            if len(self._answers) < self.capacity:
+                slot = len(self._answers)
+                self._answers.append(answer)
+                self._numbers.append(None)
+            else:
+                slot = int(np.argmin(self._last_used))
+                self._answers[slot] = answer
+            self._numbers[slot] = self._question_numbers(question)
+            self._clock += 1
+            self._vectors[slot] = vector
+            self._last_used[slot] = self._clock
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._answers),
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+        }
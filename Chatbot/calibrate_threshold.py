@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Picks RETRIEVAL_THRESHOLD from labeled questions. Every question is embedded and searched
+# like the server does it, and the best cosine similarity of its chunks is compared with its
+# label: answerable questions must stay above the threshold, unanswerable ones (facts the
+# knowledge base does not have) should fall below it and skip generation. The search is the
+# server's: V16 chunks (of the year the question names) first.
+#
+#   python calibrate_threshold.py labeled_questions.json [--min-recall 0.95] [--out calibration.json]
+#
+# The labeled file is a JSON list, or JSON lines, of {"question": "...", "answerable": true}.
+# The threshold is the highest one that still sends at least --min-recall of the answerable
+# questions to the model; put the printed RETRIEVAL_THRESHOLD line into the server's .env.
+import argparse
+import json
+import math
+import sys
+
+from model_registry import get_embeddings, get_index
+from llm import RETRIEVAL_THRESHOLD, retrieval_score, search_chunks
+from questions import read_records
+
+
+def load_labeled(path: str):
+    return [(item["question"], bool(item["answerable"])) for item in read_records(path)]
+
+
+def top_scores(labeled):
+    db = get_index()
+    if db is None:
+        print("The FAISS index could not be loaded, run ingest.py first.")
+        sys.exit(1)
+    embeddings = get_embeddings()
+    results = []
+    for question, answerable in labeled:
+        scored = search_chunks(db, question, embeddings.embed_query(question))
+        results.append((question, answerable, retrieval_score(scored)))
+    return results
+
+
+def evaluate(results, threshold: float) -> dict:
+    answerable = [score for _, label, score in results if label]
+    unanswerable = [score for _, label, score in results if not label]
+    kept = sum(score >= threshold for score in answerable)
+    skipped = sum(score < threshold for score in unanswerable)
+    return {
+        "threshold": round(threshold, 4),
+        # share of answerable questions that still reach the model
+        "recall": round(kept / len(answerable), 4) if answerable else None,
+        # share of unanswerable questions answered "not found" without generating
+        "skip_rate": round(skipped / len(unanswerable), 4) if unanswerable else None,
+    }
+
+
+def choose_threshold(results, min_recall: float) -> float:
+    scores = sorted(score for _, label, score in results if label)
+    if not scores:
+        return RETRIEVAL_THRESHOLD
+    # this many answerable questions may fall below the threshold (at least one is kept)
+    allowed = min(int((1 - min_recall) * len(scores)), len(scores) - 1)
+    # a hair under the lowest answerable score that has to be kept, rounded down (also below zero)
+    return math.floor(scores[allowed] * 1000 - 1e-6) / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pick RETRIEVAL_THRESHOLD from labeled questions")
+    parser.add_argument("labeled", help="JSON list or JSON lines of {question, answerable}")
+    parser.add_argument("--min-recall", type=float, default=0.95,
+                        help="share of answerable questions that must still be generated (default 0.95)")
+    parser.add_argument("--out", help="write the scores and the evaluation as JSON")
+    args = parser.parse_args()
+
+    labeled = load_labeled(args.labeled)
+    print(f"Scoring {len(labeled)} questions ({sum(label for _, label in labeled)} answerable)...")
+    results = top_scores(labeled)
+    threshold = choose_threshold(results, args.min_recall)
+
+    current = evaluate(results, RETRIEVAL_THRESHOLD)
+    chosen = evaluate(results, threshold)
+    print(f"Current threshold {current['threshold']}: recall {current['recall']}, skip rate {current['skip_rate']}")
+    print(f"Chosen threshold  {chosen['threshold']}: recall {chosen['recall']}, skip rate {chosen['skip_rate']}")
+    lost = sorted((score, q) for q, label, score in results if label and score < threshold)
+    if lost:
+        print("Answerable questions below the chosen threshold:")
+        for score, q in lost:
+            print(f"  {score:.3f}  {q}")
+    print(f"\nRETRIEVAL_THRESHOLD={chosen['threshold']}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "min_recall": args.min_recall,
+                "current": current,
+                "chosen": chosen,
+                "sweep": [evaluate(results, t / 100) for t in range(0, 101, 5)],
+                "scores": [{"question": q, "answerable": label, "score": round(score, 4)}
+                           for q, label, score in results],
+            }, f, indent=2)
+        print(f"Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# What ingest.py stores with every chunk: cleaned text, tags for filtered search and the
+# token IDs of the chunk's prompt block. Kept apart from llm.py so ingest does not load the
+# server's caches, metrics and model registry just to prepare chunks; llm.py uses the same
+# functions at query time for indexes built before chunks were prepared.
+import os
+import re
+
+
+def clean_text(t: str) -> str:
+    t = (t or "").replace("&nbsp;", " ")
+    t = re.sub(r"\s+", " ", t)
+    return t.strip()
+
+
+def chunk_block(source: str, text: str) -> str:
+    # how a retrieved chunk appears in the prompt's context
+    return f"[Source: {source}]: {text}"
+
+
+def tokenizer_id(tok) -> str:
+    # token IDs stored at ingest are only reused by a tokenizer with the same vocabulary
+    # (the slow and fast T5 tokenizers, or the ONNX export's copy, all give the same IDs)
+    return f"{type(tok).__name__.replace('Fast', '')}:{getattr(tok, 'vocab_size', None)}"
+
+
+def token_ids(tok, text: str) -> list:
+    return list(tok(text, add_special_tokens=False)["input_ids"])
+
+
+# model families a chunk talks about, V16 first since it is what the chatbot is about
+_MODEL_FAMILIES = {
+    "v16": re.compile(r"\bv[- ]?16\b|\bsixteen\b"),
+    "v12": re.compile(r"\bv[- ]?12\b|\btwelve\b"),
+    "v8": re.compile(r"\bv[- ]?8\b|\beight[- ]cylinder"),
+}
+_YEAR = re.compile(r"\b(19\d\d|20\d\d)\b")
+
+
+def years(text: str) -> list:
+    return [int(y) for y in _YEAR.findall(text)]
+
+
+def chunk_tags(text: str, source: str) -> dict:
+    # structured metadata ingest.py stores with every chunk, for filtered search
+    lowered = text.lower()
+    found = years(text)
+    return {
+        "model_families": [name for name, pattern in _MODEL_FAMILIES.items() if pattern.search(lowered)] or ["other"],
+        "year_from": min(found) if found else None,
+        "year_to": max(found) if found else None,
+        "source_type": os.path.splitext(source)[1].lstrip(".").lower() or "unknown",
+    }
+
+
+def prepare_chunks(docs, tok):
+    # done once by ingest.py instead of on every request: the text is cleaned and tagged
+    # before it is embedded, and the chunk's prompt block is tokenized for the LLM
+    for doc in docs:
+        doc.page_content = clean_text(doc.page_content)
+        doc.metadata["cleaned"] = True
+        doc.metadata.update(chunk_tags(doc.page_content, doc.metadata.get("source", "")))
+        doc.metadata["llm_ids"] = token_ids(tok, chunk_block(doc.metadata.get("source", "Unknown Document"),
+                                                             doc.page_content))
+        doc.metadata["llm_tokenizer"] = tokenizer_id(tok)
+    return docs
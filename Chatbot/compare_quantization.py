@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Compares fp32 and int8 (LLM_QUANTIZE=int8) inference on a fixed question set:
+# model load time, latency, RSS, and how far embeddings and answers drift from fp32.
+# Each mode runs in its own subprocess so their memory numbers do not mix.
+#
+#   python compare_quantization.py [--questions questions.json] [--out quantization_report.json]
+#
+# questions.json is a JSON list or JSON lines of questions; without it the built-in V16
+# questions of questions.py are used.
+# The first int8 run includes the one-time conversion in its load time, run it twice
+# to see the load time from the cached quantized files.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from metrics import peak_rss_mb, percentile
+from questions import DOMAIN_QUESTIONS, read_questions
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_mode(mode: str, questions, contexts_path: str, out_path: str):
+    import torch
+    import model_registry
+    from ingest import MiniLMSentenceEmbeddings
+    from bm25 import BM25Index
+    from llm import build_prompt, finalize_answer, pack_prompt, search_chunks, NUM_BEAMS
+
+    quantize = mode == "int8"
+    base_rss = rss_mb()
+    started = time.perf_counter()
+    embeddings = MiniLMSentenceEmbeddings(model_registry.EMBEDDING_MODEL_DIR, quantize=quantize)
+    model, tok = model_registry.load_llm(quantize=quantize)
+    load_seconds = time.perf_counter() - started
+    models_rss = rss_mb() - base_rss
+
+    # both modes must answer from the same context, so fp32 retrieves it and int8 reuses it
+    if os.path.exists(contexts_path):
+        with open(contexts_path) as f:
+            contexts = json.load(f)
+    else:
+        db = None
+        if os.path.exists(model_registry.INDEX_DIR):
+            from langchain_community.vectorstores import FAISS
+            db = FAISS.load_local(model_registry.INDEX_DIR, embeddings.embed_query, allow_dangerous_deserialization=True)
+            db.ncdb_bm25 = BM25Index.load(model_registry.INDEX_DIR)
+        # the packed encoder input of each question, or None without an index. Searched and
+        # packed with this process's own tokenizer: the server path would load a second model
+        # through the registry and count it against this mode's RSS
+        contexts = []
+        for q in questions:
+            hits = [doc for doc, _ in search_chunks(db, q, embeddings.embed_query(q))] if db is not None else []
+            contexts.append(pack_prompt(tok, q, hits) if hits else None)
+        with open(contexts_path, "w") as f:
+            json.dump(contexts, f)
+
+    vectors, embed_ms, answers, generate_ms = [], [], [], []
+    with torch.inference_mode():
+        # one untimed pass so lazy initialisation does not count against either mode
+        embeddings.embed_query(questions[0])
+        for q, context in zip(questions, contexts):
+            t = time.perf_counter()
+            vectors.append(embeddings.embed_query(q))
+            embed_ms.append(1000 * (time.perf_counter() - t))
+
+            if context is None:
+                inputs = tok(build_prompt(q, ""), return_tensors="pt", truncation=True, max_length=1024)
+            else:
+                inputs = {"input_ids": torch.tensor([context]), "attention_mask": torch.ones(1, len(context), dtype=torch.long)}
+            inputs = {k: v.to(model.device) for k, v in inputs.items()}
+            t = time.perf_counter()
+            out = model.generate(**inputs, max_new_tokens=150, do_sample=False,
+                                 num_beams=NUM_BEAMS, repetition_penalty=2.5)
+            generate_ms.append(1000 * (time.perf_counter() - t))
+            answers.append(finalize_answer(q, tok.decode(out[0], skip_special_tokens=True)))
+
+    with open(out_path, "w") as f:
+        json.dump({
+            "mode": mode,
+            "load_seconds": round(load_seconds, 2),
+            "models_rss_mb": round(models_rss, 1),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "embed_ms_mean": round(statistics.mean(embed_ms), 2),
+            "embed_ms_p50": round(percentile(embed_ms, 50), 2),
+            "generate_ms_mean": round(statistics.mean(generate_ms), 1),
+            "generate_ms_p50": round(percentile(generate_ms, 50), 1),
+            "generate_ms_p95": round(percentile(generate_ms, 95), 1),
+            "answers": answers,
+            "vectors": vectors,
+        }, f)
+
+
+def cosine(a, b) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
+    return dot / norm if norm else 0.0
+
+
+def word_overlap(a: str, b: str) -> float:
+    a, b = set(a.lower().split()), set(b.lower().split())
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fp32 and int8 chatbot inference")
+    parser.add_argument("--questions", help="JSON list or JSON lines of questions (default: built-in set)")
+    parser.add_argument("--out", default="quantization_report.json")
+    parser.add_argument("--run", choices=["fp32", "int8"], help=argparse.SUPPRESS)
+    parser.add_argument("--contexts", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    questions = read_questions(args.questions) if args.questions else DOMAIN_QUESTIONS
+
+    if args.run:
+        run_mode(args.run, questions, args.contexts, args.result)
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        contexts_path = os.path.join(tmp, "contexts.json")
+        for mode in ("fp32", "int8"):
+            result_path = os.path.join(tmp, f"{mode}.json")
+            cmd = [sys.executable, os.path.abspath(__file__), "--run", mode,
+                   "--contexts", contexts_path, "--result", result_path]
+            if args.questions:
+                cmd += ["--questions", args.questions]
+            print(f"Running {mode}...")
+            subprocess.run(cmd, check=True)
+            with open(result_path) as f:
+                results[mode] = json.load(f)
+
+    fp32, int8 = results["fp32"], results["int8"]
+    similarities = [cosine(a, b) for a, b in zip(fp32.pop("vectors"), int8.pop("vectors"))]
+    report = {
+        "questions": len(questions),
+        "fp32": {k: v for k, v in fp32.items() if k != "answers"},
+        "int8": {k: v for k, v in int8.items() if k != "answers"},
+        "embedding_cosine_mean": round(statistics.mean(similarities), 4),
+        "embedding_cosine_min": round(min(similarities), 4),
+        "answer_exact_match": round(sum(a == b for a, b in zip(fp32["answers"], int8["answers"])) / len(questions), 3),
+        "answer_word_overlap_mean": round(statistics.mean(
+            word_overlap(a, b) for a, b in zip(fp32["answers"], int8["answers"])), 3),
+        "answers": [{"question": q, "fp32": a, "int8": b}
+                    for q, a, b in zip(questions, fp32["answers"], int8["answers"])],
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for mode in ("fp32", "int8"):
+        r = report[mode]
+        print(f"{mode:5s} load {r['load_seconds']}s  models {r['models_rss_mb']} MB  peak {r['peak_rss_mb']} MB  "
+              f"embed {r['embed_ms_mean']} ms  generate p50 {r['generate_ms_p50']} ms p95 {r['generate_ms_p95']} ms")
+    print(f"embedding cosine mean {report['embedding_cosine_mean']} min {report['embedding_cosine_min']}, "
+          f"answers identical {report['answer_exact_match']:.0%}, word overlap {report['answer_word_overlap_mean']}")
+    print(f"Full report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
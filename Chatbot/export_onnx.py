@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Exports the chatbot models to ONNX for LLM_BACKEND=onnx and checks that ONNX Runtime
+# gives the same outputs as torch. Runs offline: flan-t5 comes from the local Hugging
+# Face cache and MiniLM from the embedding_model directory.
+#
+#   python export_onnx.py [--atol 1e-4]
+#
+# Writes ONNX_DIR/llm (encoder, decoder, decoder with past key/values, tokenizer) and
+# ONNX_DIR/embeddings (MiniLM encoder). Exits non-zero when the outputs differ.
+import argparse
+import os
+import sys
+
+# never reach out to the hub, the models are already on disk
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+import torch
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+from ingest import MiniLMSentenceEmbeddings
+from llm import build_prompt, NUM_BEAMS
+from model_registry import EMBEDDING_MODEL_DIR, LLM_MODEL
+from onnx_backend import ONNX_EMBEDDING_DIR, ONNX_LLM_DIR
+
+SAMPLE_TEXTS = [
+    "How many Cadillac V16 cars survive?",
+    "The 1930 Cadillac V-16 452 engine was the first production sixteen in America.",
+    "Fleetwood built most of the V16 bodies, including town cars and all-weather phaetons.",
+]
+SAMPLE_CONTEXT = ("[Source: car_model.csv]: Answer that respond V16: The Cadillac V-16 was produced "
+                  "from 1930 to 1940. Fleetwood and Fisher built the bodies.")
+
+
+def export():
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTModelForSeq2SeqLM
+
+    print(f"Exporting {LLM_MODEL} to {ONNX_LLM_DIR}...")
+    model = ORTModelForSeq2SeqLM.from_pretrained(LLM_MODEL, export=True, use_cache=True)
+    model.save_pretrained(ONNX_LLM_DIR)
+    AutoTokenizer.from_pretrained(LLM_MODEL).save_pretrained(ONNX_LLM_DIR)
+
+    print(f"Exporting {EMBEDDING_MODEL_DIR} to {ONNX_EMBEDDING_DIR}...")
+    encoder = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL_DIR, export=True)
+    encoder.save_pretrained(ONNX_EMBEDDING_DIR)
+    AutoTokenizer.from_pretrained(EMBEDDING_MODEL_DIR).save_pretrained(ONNX_EMBEDDING_DIR)
+
+
+@torch.inference_mode()
+def verify(atol: float, rtol: float) -> bool:
+    ok = True
+
+    torch_embeddings = MiniLMSentenceEmbeddings(EMBEDDING_MODEL_DIR)
+    onnx_embeddings = MiniLMSentenceEmbeddings(EMBEDDING_MODEL_DIR, backend="onnx")
+    expected = torch.tensor(torch_embeddings.embed_documents(SAMPLE_TEXTS))
+    actual = torch.tensor(onnx_embeddings.embed_documents(SAMPLE_TEXTS))
+    diff = (expected - actual).abs().max().item()
+    print(f"Embeddings: max abs difference {diff:.2e} (tolerance {atol:.0e})")
+    ok &= diff <= atol
+
+    from onnx_backend import load_onnx_llm
+    tok = AutoTokenizer.from_pretrained(LLM_MODEL)
+    torch_model = AutoModelForSeq2SeqLM.from_pretrained(LLM_MODEL).eval()
+    onnx_model, _ = load_onnx_llm()
+    prompts = [build_prompt(q, SAMPLE_CONTEXT) for q in SAMPLE_TEXTS[:1] + ["Who built the V16 bodies?"]]
+    inputs = tok(prompts, return_tensors="pt", padding=True, truncation=True, max_length=1024)
+
+    # the logits of one forward pass must agree within tolerance ...
+    decoder_input_ids = torch.full((len(prompts), 1), torch_model.config.decoder_start_token_id)
+    expected_logits = torch_model(**inputs, decoder_input_ids=decoder_input_ids).logits
+    actual_logits = onnx_model(**inputs, decoder_input_ids=decoder_input_ids).logits
+    diff = (expected_logits - actual_logits).abs().max().item()
+    # logits are large unnormalised values, so compare relative to their scale
+    relative = diff / max(expected_logits.abs().max().item(), 1e-9)
+    print(f"Decoder logits: max relative difference {relative:.2e} (tolerance {rtol:.0e})")
+    ok &= relative <= rtol
+
+    # ... and decoding with past key/values must produce the same answers
+    for num_beams in (1, NUM_BEAMS):
+        settings = dict(max_new_tokens=60, do_sample=False, num_beams=num_beams, repetition_penalty=2.5)
+        expected_text = tok.batch_decode(torch_model.generate(**inputs, **settings), skip_special_tokens=True)
+        actual_text = tok.batch_decode(onnx_model.generate(**inputs, **settings), skip_special_tokens=True)
+        same = expected_text == actual_text
+        print(f"Generation with {num_beams} beam(s): {'identical' if same else 'DIFFERENT'}")
+        if not same:
+            for a, b in zip(expected_text, actual_text):
+                print(f"  torch: {a}\n  onnx:  {b}")
+        ok &= same
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the chatbot models to ONNX and verify them")
+    parser.add_argument("--atol", type=float, default=1e-4, help="tolerance for embedding differences")
+    parser.add_argument("--rtol", type=float, default=1e-3, help="relative tolerance for decoder logits")
+    parser.add_argument("--verify-only", action="store_true", help="skip the export, only compare outputs")
+    args = parser.parse_args()
+    if not args.verify_only:
+        export()
+    if verify(args.atol, args.rtol):
+        print("ONNX outputs match torch. Start the server with LLM_BACKEND=onnx to use them.")
+    else:
+        print("ONNX outputs differ from torch beyond tolerance.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
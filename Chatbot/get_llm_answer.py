@@ -1,41 +1,81 @@
 import time
 import os
+import json
+import contextlib
+import contextvars
 import logging
+import asyncio
 import numpy as np
 import socket
 import signal
 import subprocess
-import transformers
+import sys
+import torch
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from ingest import MiniLMSentenceEmbeddings
-from langchain_community.vectorstores import FAISS
-from llm import generate_reply
+from model_registry import current_index, get_index, load_models, warm_up, watch_index
+from llm import (generate_reply, quick_reply, retrieve_job, polish_batch, stream_job, finalize_answer,
+                 remember_answer, ANSWER_CACHE, SEMANTIC_CACHE, GENERATION_STATS, NUM_BEAMS)
+from protocol import MAGIC, read_frame, write_frame
+from batching import MicroBatcher
+from cache import normalize_question
+from metrics import METRICS, current_trace
+from journal import Journal, worker_path
 
 # Original version used Chroma which dependended on sqlite3 so we migrated to FAISS
 # We moved the RAG logic into llm.py.
 
-HOST = 'localhost'
-PORT = 12345
 load_dotenv()
+HOST = os.environ.get("CHATBOT_HOST", "localhost")
+PORT = int(os.environ.get("CHATBOT_PORT", "12345"))
+# optional AF_UNIX socket path, Django and the model server run on the same host
+# so this skips the TCP stack entirely; the TCP port stays open as well
+UNIX_SOCKET = os.environ.get("CHATBOT_SOCKET", "")
+
+# "async" serves many connections at once and runs inference on a bounded executor,
+# "sync" keeps the original one-connection-at-a-time loop
+SERVER_MODE = os.environ.get("CHATBOT_SERVER_MODE", "async")
+# how many questions may be admitted at once (running or waiting for the executor)
+MAX_INFLIGHT = int(os.environ.get("CHATBOT_MAX_INFLIGHT", "16"))
+# how many retrieval or generate calls may run on the model at the same time
+INFERENCE_THREADS = int(os.environ.get("CHATBOT_INFERENCE_THREADS", "2"))
+# questions arriving within BATCH_WAIT_MS of each other share one generate call
+MAX_BATCH = int(os.environ.get("CHATBOT_MAX_BATCH", "8"))
+BATCH_WAIT_MS = float(os.environ.get("CHATBOT_BATCH_WAIT_MS", "25"))
+# every request gets a deadline: the client's "timeout" header, or this many seconds for
+# clients that do not send one (Django used to wait 20 s); DEADLINE_MARGIN is kept back
+# for sending the answer, so it arrives before the client gives up
+DEFAULT_TIMEOUT = float(os.environ.get("CHATBOT_DEFAULT_TIMEOUT", "20"))
+DEADLINE_MARGIN = float(os.environ.get("CHATBOT_DEADLINE_MARGIN", "1.0"))
+# admission control: questions that need the model wait in a bounded queue. When it already
+# holds MAX_QUEUE of them, or a new one would wait longer than MAX_QUEUE_WAIT seconds, the
+# question is turned away at once with a "busy" reply instead of timing out later.
+MAX_QUEUE = int(os.environ.get("CHATBOT_MAX_QUEUE", "32"))
+MAX_QUEUE_WAIT = float(os.environ.get("CHATBOT_MAX_QUEUE_WAIT", "15"))
+BUSY_MESSAGE = "The chatbot is answering many questions right now. Please try again in a minute."
+# pre-forked worker processes sharing the listening sockets (async mode only)
+WORKERS = int(os.environ.get("CHATBOT_WORKERS", "1"))
+# torch intra-op threads per worker, 0 splits the available cores evenly between workers
+TORCH_THREADS = int(os.environ.get("CHATBOT_TORCH_THREADS", "0"))
+# "" leaves scheduling to the OS, "auto" gives every worker its own slice of the cores,
+# or list the cores per worker separated by ";" (e.g. "0-3;4-7")
+CPU_AFFINITY = os.environ.get("CHATBOT_CPU_AFFINITY", "")
+# Prometheus metrics over HTTP on localhost; worker N listens on METRICS_PORT + N, 0 turns it off
+METRICS_HOST = os.environ.get("CHATBOT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("CHATBOT_METRICS_PORT", "9464"))
+# query journal for replay.py, one JSON line per question; "" turns it off. Rotated at
+# JOURNAL_MAX_MB keeping JOURNAL_BACKUPS older files, worker N > 0 writes its own file
+JOURNAL_PATH = os.environ.get("CHATBOT_JOURNAL", "query_journal.jsonl")
+JOURNAL_MAX_MB = float(os.environ.get("CHATBOT_JOURNAL_MAX_MB", "64"))
+JOURNAL_BACKUPS = int(os.environ.get("CHATBOT_JOURNAL_BACKUPS", "5"))
 
 # setting logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# the LLM and Tokenizer are loaded once at startup and kept in memory for server based architecture
-model_name = "Google/flan-t5-base"
-tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
-model = transformers.AutoModelForSeq2SeqLM.from_pretrained(model_name)
-
-# load FAISS with custom MiniLM embeddings
-embeddings_model = MiniLMSentenceEmbeddings('embedding_model')
-if os.path.exists("faiss_index"):
-    #  loading local pickle based FAISS files
-    db = FAISS.load_local("faiss_index", embeddings_model.embed_query, allow_dangerous_deserialization=True)
-    print("FAISS index loaded successfully.")
-else:
-    db = None
-    print("Warning: No FAISS index found. Run ingest.py first.")
+# the LLM, embeddings and FAISS index are loaded once by model_registry and kept in memory
+# for server based architecture; llm.py uses the same registry so there is only one copy
 
 def delRunningProcess():
     # ensure only one instance of the server runs at a time
@@ -49,8 +89,8 @@ def delRunningProcess():
     except:
         pass
 
-if __name__ == "__main__":
-    delRunningProcess()
+# the original loop, it only speaks the raw-text protocol and never keeps connections open
+def serve_sync():
      # Added SO_REUSEADDR to allow the server to restart immediately without waiting clearing the socket
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -68,6 +108,569 @@ if __name__ == "__main__":
                 print(f"Query received: {query}")
                 
                 # call generate_reply which handles context retrieval and polishing.
-                response = generate_reply(query, db=db) 
+                response = generate_reply(query, db=get_index(), deadline=request_deadline()) 
                 # Send the generated answer back to Django
                 conn.sendall(response.encode('utf-8'))
+
+
+# the event loop only accepts connections and moves bytes, the model runs on the executor
+# so a slow beam search never stops other visitors from connecting and queueing
+_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="llm")
+_inflight = None
+_worker_index = 0
+_batcher = MicroBatcher(polish_batch, _executor, max_batch=MAX_BATCH,
+                        max_wait=BATCH_WAIT_MS / 1000, parallel=INFERENCE_THREADS)
+# requests abandoned by their client while they were being answered
+_aborted = Counter()
+# normalized question -> the answer being worked out for it; identical questions that
+# arrive meanwhile wait for that one instead of running retrieval and generate again
+_flights = {}
+_coalescing = Counter()
+# questions admitted past admission control and not answered yet
+_queued = 0
+_admission = Counter()
+JOURNAL = Journal(JOURNAL_PATH, max_bytes=int(JOURNAL_MAX_MB * 1024 * 1024), backups=JOURNAL_BACKUPS)
+
+
+class QueueFull(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+# questions being answered right now, including ones waiting for admission or a batch
+_active = 0
+
+METRICS.gauge("chatbot_requests_in_flight", lambda: _active, "Questions being answered right now")
+METRICS.gauge("chatbot_admitted_questions", lambda: _queued, "Questions admitted to the generation queue")
+METRICS.gauge("chatbot_batch_queue_depth", lambda: _batcher.queue_depth, "Jobs waiting for a generate batch")
+METRICS.gauge("chatbot_coalesced_flights", lambda: len(_flights), "Distinct questions being worked on")
+
+
+@contextlib.contextmanager
+def track_request(kind: str, query: str):
+    # request count by result, and latency of the ones that got an answer. Every question
+    # also goes to the journal with the stages and route its trace collected; the caller
+    # fills in the answer length through the yielded dict
+    global _active
+    _active += 1
+    started = time.perf_counter()
+    result = "error"
+    entry = {}
+    try:
+        with METRICS.trace() as trace:
+            yield entry
+        result = "answered"
+    except QueueFull:
+        result = "busy"
+        raise
+    except (ConnectionError, asyncio.CancelledError):
+        result = "disconnected"
+        raise
+    finally:
+        _active -= 1
+        elapsed = time.perf_counter() - started
+        if result == "answered":
+            METRICS.observe("chatbot_request_seconds", elapsed, kind=kind)
+        METRICS.inc("chatbot_requests_total", kind=kind, result=result)
+        JOURNAL.record(kind=kind, q=normalize_question(query), route=trace.route or result, result=result,
+                       ms=round(1000 * elapsed, 1),
+                       stages={stage: round(1000 * seconds, 1) for stage, seconds in trace.stages.items()},
+                       chars=entry.get("chars"))
+
+
+def admit():
+    global _queued
+    expected = _batcher.expected_wait(_queued)
+    if _queued >= MAX_QUEUE:
+        _admission["rejected_full"] += 1
+        raise QueueFull(f"{_queued} questions are already waiting", expected)
+    if expected > MAX_QUEUE_WAIT:
+        _admission["rejected_wait"] += 1
+        raise QueueFull(f"expected wait of {expected:.1f} s is too long", expected)
+    _admission["admitted"] += 1
+    _queued += 1
+
+
+def release():
+    global _queued
+    _queued -= 1
+
+
+def request_deadline(timeout=None) -> float:
+    try:
+        timeout = float(timeout) if timeout is not None else DEFAULT_TIMEOUT
+    except (TypeError, ValueError):
+        timeout = DEFAULT_TIMEOUT
+    return time.monotonic() + min(timeout, DEFAULT_TIMEOUT * 3) - DEADLINE_MARGIN
+
+
+async def answer(query: str, deadline: float) -> str:
+    print(f"Query received: {query}")
+    # greetings, off-domain questions and cached answers do not need the model,
+    # so they are answered right away even when the queue is full
+    db = current_index()
+    response = quick_reply(query, db)
+    if response is not None:
+        _admission["bypassed"] += 1
+        return response
+    # single flight: the first visitor's request does the work (with its deadline),
+    # everyone asking the same question before it finishes shares the result.
+    # The work is only cancelled once every one of them has disconnected.
+    key = normalize_question(query)
+    flight = _flights.get(key)
+    if flight is None or flight["task"].cancelled():
+        admit()
+        flight = _flights[key] = {"task": asyncio.ensure_future(compute_answer(query, db, deadline)), "waiters": 0}
+
+        def landed(_, flight=flight):
+            # a newer flight for the same question may have taken the key already
+            if _flights.get(key) is flight:
+                del _flights[key]
+            release()
+        flight["task"].add_done_callback(landed)
+        _coalescing["leaders"] += 1
+    else:
+        print("Joining the identical question in flight")
+        _coalescing["coalesced"] += 1
+        trace = current_trace()
+        if trace is not None:
+            trace.route = "coalesced"
+    flight["waiters"] += 1
+    try:
+        return await asyncio.shield(flight["task"])
+    finally:
+        flight["waiters"] -= 1
+        if flight["waiters"] == 0 and not flight["task"].done():
+            # out of _flights at once: landed() only runs on a later loop iteration, and a
+            # visitor asking the same question before that must not join a cancelled flight
+            if _flights.get(key) is flight:
+                del _flights[key]
+            flight["task"].cancel()
+
+
+async def compute_answer(query: str, db, deadline: float) -> str:
+    async with _inflight:
+        loop = asyncio.get_running_loop()
+        # retrieval runs on its own, only the generate step is batched. The copied context
+        # carries the request's trace into the executor thread
+        response, job = await loop.run_in_executor(_executor, contextvars.copy_context().run,
+                                                   retrieve_job, query, db, deadline)
+        if response is None:
+            try:
+                response = await _batcher.submit(job)
+            except asyncio.CancelledError:
+                # the client went away: a queued job is dropped by the batcher,
+                # a running one stops at the next decoding step
+                job["cancel"].set()
+                raise
+            remember_answer(job, db, response)
+        return response
+
+
+async def stream_answer(writer, reply: dict, query: str, num_beams: int, deadline: float):
+    # sends "token" frames while the model decodes and one "end" frame with the final answer,
+    # so the visitor waits for the first token instead of the whole answer
+    print(f"Query received (streaming): {query}")
+    db = current_index()
+    response = quick_reply(query, db)
+    if response is not None:
+        _admission["bypassed"] += 1
+        await write_frame(writer, dict(reply, type="token"), response)
+        await write_frame(writer, dict(reply, type="end"), response)
+        return response
+    admit()
+    try:
+        return await stream_generated(writer, reply, query, db, num_beams, deadline)
+    finally:
+        release()
+
+
+async def stream_generated(writer, reply: dict, query: str, db, num_beams: int, deadline: float):
+    # returns the final answer, or None if generation failed
+    loop = asyncio.get_running_loop()
+    async with _inflight:
+        response, job = await loop.run_in_executor(_executor, contextvars.copy_context().run,
+                                                   retrieve_job, query, db, deadline)
+        if response is not None:
+            await write_frame(writer, dict(reply, type="token"), response)
+            await write_frame(writer, dict(reply, type="end"), response)
+            return response
+        pieces = asyncio.Queue()
+
+        def produce():
+            # runs on the executor, hands every decoded piece back to the event loop
+            text = []
+            try:
+                for piece in stream_job(job, num_beams):
+                    text.append(piece)
+                    loop.call_soon_threadsafe(pieces.put_nowait, ("token", piece))
+                if job["cancel"].is_set():
+                    return
+                final = finalize_answer(job["question"], "".join(text))
+                if num_beams == NUM_BEAMS and not job.get("degraded"):
+                    # reduced-beam answers are not cached, they would be served to non-streaming visitors too
+                    remember_answer(job, db, final)
+                loop.call_soon_threadsafe(pieces.put_nowait, ("end", final))
+            except Exception as e:
+                logger.exception(f"Failed to stream answer: {e}")
+                loop.call_soon_threadsafe(pieces.put_nowait, ("error", str(e)))
+
+        producer = loop.run_in_executor(_executor, contextvars.copy_context().run, produce)
+        try:
+            while True:
+                kind, text = await pieces.get()
+                if kind == "error":
+                    await write_frame(writer, dict(reply, type="error", error=text))
+                    return None
+                await write_frame(writer, dict(reply, type=kind), text)
+                if kind == "end":
+                    return text
+        except (asyncio.CancelledError, ConnectionError):
+            # nobody reads the tokens any more, stop decoding them
+            job["cancel"].set()
+            raise
+        finally:
+            await producer
+
+
+def server_stats() -> dict:
+    return {
+        "worker": _worker_index,
+        "pid": os.getpid(),
+        "batching": _batcher.stats(),
+        "answer_cache": ANSWER_CACHE.stats(),
+        "semantic_cache": SEMANTIC_CACHE.stats(),
+        "generation": dict(GENERATION_STATS),
+        "coalescing": {
+            "in_flight": len(_flights),
+            "leaders": _coalescing["leaders"],
+            "coalesced": _coalescing["coalesced"],
+        },
+        "admission": {
+            "queued": _queued,
+            "max_queue": MAX_QUEUE,
+            "max_queue_wait_s": MAX_QUEUE_WAIT,
+            "expected_wait_s": round(_batcher.expected_wait(_queued), 2),
+            "admitted": _admission["admitted"],
+            "bypassed": _admission["bypassed"],
+            "rejected_full": _admission["rejected_full"],
+            "rejected_wait": _admission["rejected_wait"],
+        },
+        "aborted": {
+            "disconnected": _aborted["disconnected"],
+            "dropped_from_queue": _batcher.dropped,
+            "cancelled_before_start": GENERATION_STATS["cancelled_before_start"],
+            "cancelled_during_generation": GENERATION_STATS["cancelled_during_generation"],
+        },
+        "journal": JOURNAL.stats(),
+    }
+
+
+def metrics_snapshot() -> dict:
+    return dict(METRICS.snapshot(), worker=_worker_index, pid=os.getpid())
+
+
+async def handle_metrics(reader, writer):
+    # just enough HTTP for a Prometheus scrape: GET /metrics, or /metrics.json for the snapshot
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass
+        parts = request_line.decode("latin-1").split()
+        path = parts[1] if len(parts) > 1 else "/"
+        if path.startswith("/metrics.json"):
+            status, content_type, body = "200 OK", "application/json", json.dumps(metrics_snapshot())
+        elif path.startswith("/metrics"):
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", METRICS.prometheus()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+        data = body.encode("utf-8")
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def _client_gone(read) -> bool:
+    # a finished read that hit EOF or an error means the client closed its connection
+    return read.done() and (read.exception() is not None or read.result() in (None, b""))
+
+
+async def watch_client(work, next_read):
+    # runs one request while a read from the same connection is pending. Clients do not
+    # send anything while they wait for an answer, so if that read ends in EOF the client
+    # has given up (Django timed out) and the request is cancelled instead of finished.
+    # A pipelined request simply stays in next_read until this one is answered.
+    work = asyncio.ensure_future(work)
+    await asyncio.wait({work, next_read}, return_when=asyncio.FIRST_COMPLETED)
+    if not work.done() and _client_gone(next_read):
+        work.cancel()
+        await asyncio.wait({work})
+        _aborted["disconnected"] += 1
+        raise ConnectionResetError("client disconnected before the answer was ready")
+    return await work
+
+
+async def handle_legacy(reader, writer, head: bytes):
+    # old clients write the raw question and read a raw answer, one per connection
+    query = (head + await reader.read(1024 - len(head))).decode('utf-8')
+    if not query:
+        return
+    next_read = asyncio.ensure_future(reader.read(1))
+    try:
+        with track_request("legacy", query) as entry:
+            response = await watch_client(answer(query, request_deadline()), next_read)
+            entry["chars"] = len(response)
+    except QueueFull as e:
+        logger.info(f"Turned a question away: {e}")
+        response = BUSY_MESSAGE
+    finally:
+        next_read.cancel()
+    writer.write(response.encode('utf-8'))
+    await writer.drain()
+
+
+async def write_busy(writer, reply: dict, e: QueueFull):
+    # a distinct reply, so clients can tell overload apart from a failed question
+    logger.info(f"Turned a question away: {e}")
+    await write_frame(writer, dict(reply, type="busy", reason=str(e), retry_after=round(max(e.retry_after, 1), 1)),
+                      BUSY_MESSAGE)
+
+
+async def handle_framed(reader, writer, head: bytes):
+    # framed clients keep the connection open and send one request after another;
+    # the next frame is always being read, which is how a disconnect is noticed mid-request
+    next_read = asyncio.ensure_future(read_frame(reader, head))
+    try:
+        while True:
+            frame = await next_read
+            if frame is None:
+                return
+            next_read = asyncio.ensure_future(read_frame(reader))
+            header, body = frame
+            reply = {"id": header.get("id")}
+            kind = header.get("type")
+            if kind == "ask" and header.get("stream"):
+                # beams are chosen per request, 1 (greedy) streams token by token
+                try:
+                    num_beams = max(1, min(int(header.get("num_beams") or 1), NUM_BEAMS))
+                except (TypeError, ValueError):
+                    num_beams = 1
+                try:
+                    with track_request("stream", body) as entry:
+                        final = await watch_client(stream_answer(writer, reply, body, num_beams,
+                                                                 request_deadline(header.get("timeout"))), next_read)
+                        entry["chars"] = len(final) if final is not None else None
+                except ConnectionError:
+                    raise
+                except QueueFull as e:
+                    await write_busy(writer, reply, e)
+                except Exception as e:
+                    # an answer to the client, not a dropped connection its breaker would count
+                    logger.exception(f"Failed to stream an answer to query: {e}")
+                    await write_frame(writer, dict(reply, type="error", error=str(e)))
+            elif kind == "ask":
+                try:
+                    with track_request("ask", body) as entry:
+                        response = await watch_client(answer(body, request_deadline(header.get("timeout"))), next_read)
+                        entry["chars"] = len(response)
+                except ConnectionError:
+                    raise
+                except QueueFull as e:
+                    await write_busy(writer, reply, e)
+                    continue
+                except Exception as e:
+                    logger.exception(f"Failed to answer query: {e}")
+                    await write_frame(writer, dict(reply, type="error", error=str(e)))
+                    continue
+                await write_frame(writer, dict(reply, type="answer"), response)
+            elif kind == "ping":
+                # pooled clients check idle connections with this before reusing them
+                await write_frame(writer, dict(reply, type="pong"))
+            elif kind == "stats":
+                await write_frame(writer, dict(reply, type="stats"), json.dumps(server_stats()))
+            elif kind == "metrics":
+                await write_frame(writer, dict(reply, type="metrics"), json.dumps(metrics_snapshot()))
+            else:
+                await write_frame(writer, dict(reply, type="error", error=f"unknown message type {kind!r}"))
+    finally:
+        next_read.cancel()
+
+
+async def handle_client(reader, writer):
+    try:
+        # framed clients always start with a NUL byte, old clients start with the question text
+        head = await reader.read(1)
+        if head == MAGIC[:1]:
+            await handle_framed(reader, writer, head)
+        else:
+            await handle_legacy(reader, writer, head)
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        logger.info(f"Client went away: {e}")
+    except Exception as e:
+        logger.exception(f"Failed to answer query: {e}")
+    finally:
+        writer.close()
+
+
+def bind_sockets():
+    # bound before forking so every worker accepts from the same listening sockets
+    # Added SO_REUSEADDR to allow the server to restart immediately without waiting clearing the socket
+    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp.bind((HOST, PORT))
+    tcp.listen(128)
+    sockets = [tcp]
+    if UNIX_SOCKET:
+        # remove a stale socket file left behind by a previous run
+        if os.path.exists(UNIX_SOCKET):
+            os.unlink(UNIX_SOCKET)
+        unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix.bind(UNIX_SOCKET)
+        os.chmod(UNIX_SOCKET, 0o660)
+        unix.listen(128)
+        sockets.append(unix)
+    return sockets
+
+
+async def serve_async(sockets):
+    global _inflight
+    _inflight = asyncio.Semaphore(MAX_INFLIGHT)
+    # the loop only reads the loaded index; loading and reloading it happen off the loop
+    await asyncio.get_running_loop().run_in_executor(_executor, get_index)
+    watch_index()
+    asyncio.ensure_future(_batcher.run())
+    servers = []
+    for sock in sockets:
+        if sock.family == socket.AF_UNIX:
+            servers.append(await asyncio.start_unix_server(handle_client, sock=sock))
+        else:
+            servers.append(await asyncio.start_server(handle_client, sock=sock))
+    print(f"Chatbot server started on {HOST}:{PORT} "
+          f"(async, worker {_worker_index}, {MAX_INFLIGHT} in flight, {INFERENCE_THREADS} inference threads, "
+          f"batches of up to {MAX_BATCH} within {BATCH_WAIT_MS:g} ms)")
+    if UNIX_SOCKET:
+        print(f"Chatbot server also listening on unix:{UNIX_SOCKET}")
+    if METRICS_PORT:
+        # each worker has its own metrics, so each gets its own port
+        port = METRICS_PORT + _worker_index
+        try:
+            servers.append(await asyncio.start_server(handle_metrics, METRICS_HOST, port))
+            print(f"Metrics on http://{METRICS_HOST}:{port}/metrics")
+        except OSError as e:
+            logger.warning(f"Could not open the metrics port {port}: {e}")
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def parse_cpu_list(text: str) -> set:
+    # "0-3,8" -> {0, 1, 2, 3, 8}
+    cpus = set()
+    for part in text.split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+def worker_cpus(index: int):
+    if not CPU_AFFINITY:
+        return None
+    if CPU_AFFINITY == "auto":
+        cpus = sorted(os.sched_getaffinity(0))
+        per_worker = max(1, len(cpus) // WORKERS)
+        start = (index * per_worker) % len(cpus)
+        return set(cpus[start:start + per_worker])
+    groups = CPU_AFFINITY.split(";")
+    return parse_cpu_list(groups[index % len(groups)])
+
+
+def setup_worker(index: int):
+    # pin the worker and size its torch thread pool so workers do not oversubscribe the cores
+    global _worker_index
+    _worker_index = index
+    JOURNAL.path = worker_path(JOURNAL_PATH, index)
+    cpus = worker_cpus(index)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    threads = TORCH_THREADS or max(1, len(cpus) if cpus else (os.cpu_count() or 1) // WORKERS)
+    torch.set_num_threads(threads)
+    print(f"Worker {index} (pid {os.getpid()}) using {threads} torch threads"
+          + (f" on cpus {sorted(cpus)}" if cpus else ""))
+
+
+def serve_prefork():
+    # Weights and the FAISS index are loaded once in the parent and shared copy-on-write by the
+    # workers, which never write to them (ONNX sessions excepted, see load_models). No
+    # inference runs in the parent: torch's thread pools do not survive fork, so each worker
+    # warms up on its own.
+    load_models()
+    sockets = bind_sockets()
+    children = {}
+
+    def stop_worker(signum, frame):
+        raise SystemExit(0)
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            # stopping unwinds serve_async, so the worker saves its answers and journal below
+            signal.signal(signal.SIGTERM, stop_worker)
+            signal.signal(signal.SIGINT, stop_worker)
+            code = 1
+            try:
+                setup_worker(index)
+                warm_up()
+                asyncio.run(serve_async(sockets))
+            except SystemExit:
+                code = 0
+            except BaseException:
+                logger.exception(f"Worker {index} stopped")
+            finally:
+                # os._exit skips atexit, which would otherwise do this
+                ANSWER_CACHE.flush()
+                JOURNAL.flush()
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    for index in range(WORKERS):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Chatbot server started {WORKERS} workers on {HOST}:{PORT}")
+    # replace workers that die so the server keeps its capacity
+    while True:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is not None:
+            logger.warning(f"Worker {index} (pid {pid}) exited with status {status}, restarting it")
+            time.sleep(1)
+            spawn(index)
+
+
+if __name__ == "__main__":
+    delRunningProcess()
+    if SERVER_MODE == "sync":
+        warm_up()
+        serve_sync()
+    elif WORKERS > 1:
+        serve_prefork()
+    else:
+        # load and exercise every model before the socket starts listening
+        setup_worker(0)
+        warm_up()
+        asyncio.run(serve_async(bind_sockets()))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import sys
 import subprocess
 import glob
 import json
@@ -15,23 +16,46 @@ import torch
 import torch.nn.functional as F
 from transformers import AutoTokenizer, AutoModel
 
-# we switch from Chroma to FAISS
-from langchain_community.vectorstores import FAISS
 from langchain.docstore.document import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 # we use pdfplumber that is already in ml environment
 from langchain_community.document_loaders import PDFPlumberLoader, TextLoader, CSVLoader
 
+from bm25 import BM25Index
+from chunks import prepare_chunks
+from vector_index import INDEX_TYPES, make_store
+from model_registry import LLM_MODEL
+
 load_dotenv()
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 persist_directory = "faiss_index" 
 source_directory = "source_documents"
+# flat (exact), hnsw, ivf_flat or ivf_pq, see vector_index.py and bench_index.py.
+# FAISS_NLIST 0 picks about 4 * sqrt(chunks) clusters; IVF types train on FAISS_TRAIN_SAMPLE chunks
+INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "flat")
+INDEX_PARAMS = {
+    "nlist": int(os.environ.get("FAISS_NLIST", "0")),
+    "hnsw_m": int(os.environ.get("FAISS_HNSW_M", "32")),
+    "pq_m": int(os.environ.get("FAISS_PQ_M", "16")),
+    "train_sample": int(os.environ.get("FAISS_TRAIN_SAMPLE", "50000")),
+}
 
 class MiniLMSentenceEmbeddings():
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, quantize: bool = False, backend: str = "torch"):
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-        self.model = AutoModel.from_pretrained(model_path)
+        if backend == "onnx":
+            # exported from the same model_path by export_onnx.py, returns the same outputs
+            from onnx_backend import load_onnx_encoder
+            self.model = load_onnx_encoder()
+            return
+        if quantize:
+            # int8 Linear layers for the query path of the CPU-only server, see quantize.py
+            from quantize import load_quantized
+            self.model = load_quantized(model_path, lambda: AutoModel.from_pretrained(model_path))
+        else:
+            self.model = AutoModel.from_pretrained(model_path)
+        self.model.eval()
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         batch_size = 32  
@@ -100,6 +124,10 @@ def load_single_document(file_path: str) -> List[Document]:
     return []
 
 def main():
+    # fail before the slow part rather than after embedding every chunk
+    if INDEX_TYPE not in INDEX_TYPES:
+        print(f"Unknown FAISS_INDEX_TYPE {INDEX_TYPE!r}, expected one of {', '.join(INDEX_TYPES)}")
+        sys.exit(1)
     # load emdedding model
     embeddings = MiniLMSentenceEmbeddings('embedding_model')
     
@@ -121,12 +149,22 @@ def main():
     texts = text_splitter.split_documents(documents)
     print(f"Split into {len(texts)} chunks.")
 
+    # clean and tokenize every chunk once here, so requests only pack the stored token IDs
+    print(f"Tokenizing chunks for {LLM_MODEL}...")
+    prepare_chunks(texts, AutoTokenizer.from_pretrained(LLM_MODEL))
+
     # we no longer use sqllite so build the index directly in RAM
-    print("Creating FAISS index...")
-    vectorstore = FAISS.from_documents(texts, embeddings)
+    print(f"Creating FAISS index ({INDEX_TYPE})...")
+    vectorstore = make_store(texts, embeddings, INDEX_TYPE, **INDEX_PARAMS)
     
+    # the lexical index for hybrid retrieval; its rows are the FAISS rows, in the same order.
+    # Built before anything is written, so bm25.pkl follows index.faiss within moments: the
+    # server does not load an index.faiss newer than its bm25.pkl
+    bm25 = BM25Index.build([doc.page_content for doc in texts])
+
     # Save the vector index as a local binary file
     vectorstore.save_local(persist_directory)
+    bm25.save(persist_directory)
     print(f"Success! FAISS index saved to {persist_directory}")
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+# Query journal: one JSON line per request the server answered (or turned away), for
+# realistic load tests with replay.py. Each line holds the time, the normalized question,
+# the request kind, the route that answered it, stage timings and the answer length:
+#
+#   {"ts": 1718000000.123, "kind": "ask", "q": "how many v16 cars survive", "route": "answered",
+#    "result": "answered", "ms": 812.4, "stages": {"embed": 6.1, "search": 1.2, ...}, "chars": 214}
+#
+# record() only puts the entry on a bounded queue; a background thread does the JSON encoding
+# and the writing. When the disk cannot keep up the entry is dropped and counted instead of
+# making a visitor wait. The file is rotated at max_bytes, keeping `backups` older files
+# (queries.jsonl.1 is the newest of them).
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+
+class Journal:
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, backups: int = 5, queue_size: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer_pid = None
+        self._file = None
+
+    def record(self, **entry):
+        if not self.path:
+            return
+        if self._writer_pid != os.getpid():
+            # started lazily because threads do not survive the server forking its workers
+            self._writer_pid = os.getpid()
+            self._file = None
+            threading.Thread(target=self._write_forever, daemon=True, name="journal").start()
+            atexit.register(self.flush)
+        entry = {"ts": round(time.time(), 3), **entry}
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.unlink(self.path)
+        self.rotations += 1
+        self._open()
+
+    def _write(self, entry):
+        if self._file is None:
+            self._open()
+        self._file.write(json.dumps(entry, separators=(",", ":"), ensure_ascii=False) + "\n")
+        self.written += 1
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _write_forever(self):
+        while True:
+            entry = self._queue.get()
+            try:
+                self._write(entry)
+                # flush once the queue is drained, not after every line
+                if self._queue.empty():
+                    self._file.flush()
+            except (OSError, TypeError, ValueError) as e:
+                self.dropped += 1
+                print(f"Could not write to the query journal {self.path}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        # waits for the queued entries, used at exit
+        if self._writer_pid == os.getpid():
+            self._queue.join()
+            if self._file is not None:
+                self._file.flush()
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "written": self.written,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize(),
+            "rotations": self.rotations,
+        }
+
+
+def worker_path(path: str, index: int) -> str:
+    # every worker process writes and rotates its own file: queries.jsonl, queries-w1.jsonl, ...
+    if not path or not index:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f"{stem}-w{index}{ext}"
+
+
+def read_journal(paths):
+    # entries of one or more journal files (rotated ones included), oldest first
+    entries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+    entries.sort(key=lambda e: e.get("ts", 0))
+    return entries
@@ -1,19 +1,74 @@
 import os
 import re
+import threading
+import time
+from collections import Counter
+import numpy as np
 import torch
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+# models are owned by the registry so the server and this module share one copy
+from model_registry import get_llm
+from cache import AnswerCache, SemanticCache, normalize_question
+from chunks import chunk_block, chunk_tags, clean_text, token_ids, tokenizer_id, years
+from metrics import METRICS, current_trace
 
 #Configuration
 KB_DIR = os.environ.get("KB_DIR", "/home/metacomp/NCDBContent/CDB/Dbas_txt/")
-LLM_MODEL = os.environ.get("LLM_MODEL", "google/flan-t5-base")
-RETRIEVAL_THRESHOLD = 0.05
+# questions whose best hit has a lower cosine similarity than this get the not-found answer
+# straight after the search, without a beam search over unrelated context.
+# calibrate_threshold.py picks a value from labeled questions
+RETRIEVAL_THRESHOLD = float(os.environ.get("RETRIEVAL_THRESHOLD", "0.05"))
 TOP_K = 5
+# chunks that go into the prompt's context
+CONTEXT_CHUNKS = 2
+# FAISS cannot filter on metadata while it searches, so filtered searches fetch
+# k * SEARCH_OVERFETCH neighbours and widen by that factor until k of them match,
+# giving up after SEARCH_MAX_FETCH
+SEARCH_OVERFETCH = int(os.environ.get("SEARCH_OVERFETCH", "4"))
+SEARCH_MAX_FETCH = int(os.environ.get("SEARCH_MAX_FETCH", "1024"))
+# dense and BM25 rankings are merged by reciprocal rank fusion: a chunk gets
+# 1 / (HYBRID_RRF_K + rank) from each ranking it appears in
+HYBRID_RRF_K = int(os.environ.get("HYBRID_RRF_K", "60"))
+NOT_FOUND_ANSWER = "I am sorry, I do not have enough information."
+# beam search cannot hand out tokens as they are decoded, so streaming defaults to greedy
+NUM_BEAMS = 4
+STREAM_NUM_BEAMS = 1
 
 # LIMITED the size chunk to the llm
 MAX_CHARS_PER_CHUNK = 500
+# the encoder input is packed from token IDs stored by ingest.py: instruction and question
+# always fit whole, the retrieved chunks share what is left of PROMPT_TOKEN_BUDGET, each
+# at most MAX_TOKENS_PER_CHUNK long. A chunk that would get fewer than MIN_CHUNK_TOKENS is left out.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "512"))
+MAX_TOKENS_PER_CHUNK = int(os.environ.get("MAX_TOKENS_PER_CHUNK", "160"))
+MIN_CHUNK_TOKENS = 16
+# longer than any token of the flan-t5 vocabulary, used to cut questions before tokenizing
+MAX_CHARS_PER_TOKEN = 32
 
-_MODEL = None
-_TOKENIZER = None
+# generation budget: answers are at most MAX_NEW_TOKENS long, and when a request's deadline
+# leaves room for fewer than MIN_NEW_TOKENS it gets an extractive answer instead
+MAX_NEW_TOKENS = 150
+MIN_NEW_TOKENS = int(os.environ.get("MIN_NEW_TOKENS", "24"))
+# with this many questions waiting behind a batch it uses fewer beams, so the queue drains faster
+BUSY_QUEUE_DEPTH = int(os.environ.get("BUSY_QUEUE_DEPTH", "8"))
+# running estimate of decoding cost (seconds per generated token per beam), updated after
+# every generate call and used to size the next one
+_SECONDS_PER_BEAM_TOKEN = 0.01
+GENERATION_STATS = Counter()
+
+# generated answers are cached per normalized question and per loaded index,
+# ANSWER_CACHE_FILE keeps them across server restarts
+ANSWER_CACHE = AnswerCache(
+    maxsize=int(os.environ.get("ANSWER_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("ANSWER_CACHE_TTL", "86400")),
+    path=os.environ.get("ANSWER_CACHE_FILE", ""),
+)
+# paraphrases of a cached question ("how many V16s survive" / "number of surviving V-16 cars")
+# are matched on their MiniLM embedding, which retrieval computes anyway
+SEMANTIC_CACHE = SemanticCache(
+    capacity=int(os.environ.get("SEMANTIC_CACHE_SIZE", "512")),
+    threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+)
 
 #Greeting Keywords
 _GREETINGS = (
@@ -39,86 +94,530 @@ def is_domain_question(q: str) -> bool:
     if not ql: return False
     return any(h in ql for h in _DOMAIN_HINTS)
 
-#Extract the docusments and clean text
-def clean_text(t: str) -> str:
-    t = (t or "").replace("&nbsp;", " ")
-    t = re.sub(r"\s+", " ", t)
-    return t.strip()
+_PROMPT_HEAD = """Read the context carefully. It contains historical facts about Cadillac cars. 
+Your task is to answer the question specifically about the Cadillac V16 (produced 1930-1940).
+If the context mentions other models like Eldorados or years after 1940, IGNORE them.
+
+Context: """
+
+
+_ANSWER_CUE = """ 
+
+Answer (focused ONLY on V16):"""
+
+
+def _prompt_tail(question: str) -> str:
+    return f""" 
+Question: {question}""" + _ANSWER_CUE
+
+
+def build_prompt(question: str, context_text: str) -> str:
+    return (_PROMPT_HEAD + context_text + _prompt_tail(question)).strip()
+
+
+def _chunk_text(doc) -> str:
+    return doc.page_content if doc.metadata.get("cleaned") else clean_text(doc.page_content)
+
+
+def _chunk_ids(tok, doc) -> list:
+    # indexes built before chunks were pre-tokenized (or with another tokenizer) still work,
+    # they pay for cleaning and tokenizing the chunk on every request
+    ids = doc.metadata.get("llm_ids")
+    if ids is not None and doc.metadata.get("llm_tokenizer") == tokenizer_id(tok):
+        return ids
+    return token_ids(tok, chunk_block(doc.metadata.get("source", "Unknown Document"), _chunk_text(doc)))
+
+
+_HEAD_IDS = {}
+
+
+def pack_prompt(tok, question: str, docs) -> list:
+    # encoder input IDs for the question and the ranked chunks within PROMPT_TOKEN_BUDGET.
+    # The instruction is never cut and the context gets the tokens the question leaves over.
+    # A question too long for the budget on its own is cut, keeping the answer cue after it
+    key = tokenizer_id(tok)
+    head = _HEAD_IDS.get(key)
+    if head is None:
+        head = _HEAD_IDS[key] = token_ids(tok, _PROMPT_HEAD.rstrip())
+    # no token is longer than this many characters, so a huge request body is not tokenized whole
+    tail = token_ids(tok, _prompt_tail(question[:PROMPT_TOKEN_BUDGET * MAX_CHARS_PER_TOKEN]))
+    over = len(head) + len(tail) + 1 - PROMPT_TOKEN_BUDGET
+    if over > 0:
+        cue = token_ids(tok, _ANSWER_CUE)
+        tail = tail[:max(0, len(tail) - len(cue) - over)] + cue
+    room = PROMPT_TOKEN_BUDGET - len(head) - len(tail) - 1
+    context = []
+    for doc in docs:
+        left = min(room - len(context), MAX_TOKENS_PER_CHUNK)
+        if left < MIN_CHUNK_TOKENS:
+            break
+        context.extend(_chunk_ids(tok, doc)[:left])
+    return head + context + tail + [tok.eos_token_id]
+
+
+def finalize_answer(question: str, text: str) -> str:
+    text = text.strip()
+    if text.lower().strip("?") == question.lower().strip("?"):
+        return "I am sorry, I could not find specific details about that in the database."
+    return text if len(text) > 3 else "I do not know."
+
+
+_STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "to", "and", "or", "is", "was", "were", "are",
+    "what", "which", "who", "when", "how", "many", "much", "did", "does", "do", "cadillac",
+}
+
+
+def extractive_answer(question: str, text: str) -> str:
+    # best-matching sentence(s) of the top retrieved chunk, for requests that have no time
+    # left to generate; still a real answer instead of "I do not know."
+    sentences = [s for s in re.split(r"(?<=[.!?])\s+", clean_text(text)) if s]
+    if not sentences:
+        return "I do not know."
+    words = {w for w in re.findall(r"\w+", question.lower()) if w not in _STOPWORDS}
+    best = max(range(len(sentences)), key=lambda i: len(words & set(re.findall(r"\w+", sentences[i].lower()))))
+    answer = sentences[best]
+    if len(answer) < 120 and best + 1 < len(sentences):
+        answer += " " + sentences[best + 1]
+    return answer[:MAX_CHARS_PER_CHUNK]
+
+
+def _trim_to_sentence(text: str) -> str:
+    # generation cut off by the deadline ends mid-sentence, keep the complete sentences
+    ends = [m.end() for m in re.finditer(r"[.!?](\s|$)", text)]
+    return text[:ends[-1]].strip() if ends and ends[-1] > 20 else text
+
+
+def plan_generation(remaining, queue_depth: int = 0, num_beams: int = NUM_BEAMS):
+    # (num_beams, max_new_tokens) that fit into the remaining seconds, or None if nothing fits
+    if remaining is None:
+        return num_beams, MAX_NEW_TOKENS
+    if queue_depth >= BUSY_QUEUE_DEPTH:
+        num_beams = 1
+    elif queue_depth >= BUSY_QUEUE_DEPTH // 2:
+        num_beams = min(num_beams, 2)
+    while True:
+        tokens = int(max(remaining, 0) / (_SECONDS_PER_BEAM_TOKEN * num_beams))
+        if tokens >= MIN_NEW_TOKENS or num_beams == 1:
+            break
+        num_beams = max(1, num_beams // 2)
+    if tokens < MIN_NEW_TOKENS:
+        return None
+    return num_beams, min(MAX_NEW_TOKENS, tokens)
+
+
+def _remaining(job, now):
+    deadline = job.get("deadline")
+    return None if deadline is None else deadline - now
 
 
-def get_llm():
-    global _MODEL, _TOKENIZER
-    if _MODEL is not None and _TOKENIZER is not None:
-        return _MODEL, _TOKENIZER
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    _TOKENIZER = AutoTokenizer.from_pretrained(LLM_MODEL)
-    _MODEL = AutoModelForSeq2SeqLM.from_pretrained(LLM_MODEL).to(device)
-    _MODEL.eval()
-    return _MODEL, _TOKENIZER
+def _record_cost(elapsed: float, steps: int, num_beams: int):
+    global _SECONDS_PER_BEAM_TOKEN
+    if steps > 0:
+        _SECONDS_PER_BEAM_TOKEN = 0.8 * _SECONDS_PER_BEAM_TOKEN + 0.2 * elapsed / (steps * num_beams)
 
 
+def _cancelled(job) -> bool:
+    cancel = job.get("cancel")
+    return cancel is not None and cancel.is_set()
+
+
+class CancelCriteria(StoppingCriteria):
+    # checked by generate between decoding steps; stops once every job of the batch was
+    # cancelled (its client disconnected), the others in a shared batch still need the answer
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.stopped = False
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        self.stopped = all(_cancelled(job) for job in self.jobs)
+        return self.stopped
+
+
+def _encode(tok, jobs, device):
+    # jobs from retrieve_job carry their packed input_ids, others (polish_with_llm) a context string
+    rows = [job.get("input_ids") or list(tok(build_prompt(job["question"], job["context"]),
+                                             truncation=True, max_length=1024)["input_ids"])
+            for job in jobs]
+    width = max(len(row) for row in rows)
+    input_ids = torch.tensor([row + [tok.pad_token_id] * (width - len(row)) for row in rows])
+    attention_mask = torch.tensor([[1] * len(row) + [0] * (width - len(row)) for row in rows])
+    return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
+
+
+# runs several jobs from prepare_reply through one padded generate call,
+# on CPU this costs far less than the same number of single-prompt calls.
+# Jobs may carry a "deadline" (time.monotonic() seconds): beams and token budget then
+# shrink to fit the tightest one, and generate stops on its own before it passes.
+# A job's "cancel" event (set when its client disconnects) skips or aborts its generation.
 @torch.inference_mode()
-def polish_with_llm(question: str, context_text: str) -> str:
-    model, tok = get_llm()
-    prompt = f"""
-Read the context carefully. It contains historical facts about Cadillac cars. 
-Your task is to answer the question specifically about the Cadillac V16 (produced 1930-1940).
-If the context mentions other models like Eldorados or years after 1940, IGNORE them.
+def polish_batch(jobs, num_beams: int = None, queue_depth: int = 0) -> list:
+    # one batch serves several requests, each of their traces gets the batch's stage timings
+    with METRICS.trace() as batch:
+        answers = _generate_batch(jobs, num_beams, queue_depth)
+    for job in jobs:
+        if job.get("trace") is not None:
+            job["trace"].merge(batch)
+    return answers
+
+
+def _set_route(jobs, route: str):
+    for job in jobs:
+        if job.get("trace") is not None:
+            job["trace"].route = route
 
-Context: {context_text} 
-Question: {question} 
 
-Answer (focused ONLY on V16):""".strip()
-    inputs = tok(prompt, return_tensors="pt", truncation=True, max_length=1024)
-    inputs = {k: v.to(model.device) for k, v in inputs.items()}
-    
+def _generate_batch(jobs, num_beams: int = None, queue_depth: int = 0) -> list:
+    requested_beams = num_beams or NUM_BEAMS
+    answers = [None] * len(jobs)
+    pending = []
+    for i, job in enumerate(jobs):
+        if _cancelled(job):
+            answers[i] = ""
+            job["degraded"] = True
+            GENERATION_STATS["cancelled_before_start"] += 1
+            _set_route([job], "cancelled")
+        else:
+            pending.append(i)
+    while pending:
+        now = time.monotonic()
+        left = [_remaining(jobs[i], now) for i in pending]
+        remaining = min((r for r in left if r is not None), default=None)
+        plan = plan_generation(remaining, queue_depth, requested_beams)
+        if plan is not None:
+            break
+        # the tightest job cannot be served even alone, answer it from its top chunk
+        for i, r in zip(list(pending), left):
+            if r == remaining:
+                answers[i] = extractive_answer(jobs[i]["question"], jobs[i].get("top_chunk", ""))
+                jobs[i]["degraded"] = True
+                GENERATION_STATS["extractive"] += 1
+                METRICS.inc("chatbot_answers_total", outcome="fallback")
+                _set_route([jobs[i]], "fallback")
+                pending.remove(i)
+    if not pending:
+        return answers
+
+    beams, max_new_tokens = plan
+    if beams < requested_beams:
+        GENERATION_STATS["reduced_beams"] += 1
+    model, tok = get_llm()
+    with METRICS.time("chatbot_stage_seconds", stage="tokenize"):
+        inputs = _encode(tok, [jobs[i] for i in pending], model.device)
+
+    cancel = CancelCriteria([jobs[i] for i in pending])
+    started = time.monotonic()
     out = model.generate(
         **inputs,
-        max_new_tokens=150,
+        max_new_tokens=max_new_tokens,
         do_sample=False,
-        num_beams=4,
+        num_beams=beams,
         repetition_penalty=2.5, 
+        max_time=remaining,
+        stopping_criteria=StoppingCriteriaList([cancel]),
     )
-    text = tok.decode(out[0], skip_special_tokens=True).strip()
-    
-    if text.lower().strip("?") == question.lower().strip("?"):
-        return "I am sorry, I could not find specific details about that in the database."
-    return text if len(text) > 3 else "I do not know."
+    elapsed = time.monotonic() - started
+    METRICS.observe("chatbot_stage_seconds", elapsed, stage="generate")
+    if cancel.stopped:
+        # nobody is waiting for these answers any more
+        GENERATION_STATS["cancelled_during_generation"] += len(pending)
+        METRICS.inc("chatbot_answers_total", len(pending), outcome="cancelled")
+        _set_route([jobs[i] for i in pending], "cancelled")
+        for i in pending:
+            jobs[i]["degraded"] = True
+            answers[i] = ""
+        return answers
+    GENERATION_STATS["generated"] += len(pending)
+    METRICS.inc("chatbot_answers_total", len(pending), outcome="answered")
+    _set_route([jobs[i] for i in pending], "answered")
+    _record_cost(elapsed, out.shape[1] - 1, beams)
+    time_limited = remaining is not None and elapsed >= remaining
+    if time_limited:
+        GENERATION_STATS["time_limited"] += 1
+    with METRICS.time("chatbot_stage_seconds", stage="decode"):
+        texts = tok.batch_decode(out, skip_special_tokens=True)
+    for i, text in zip(pending, texts):
+        # answers squeezed by the deadline are not cached, a calmer moment gives a better one
+        jobs[i]["degraded"] = time_limited or beams < requested_beams
+        answers[i] = finalize_answer(jobs[i]["question"], _trim_to_sentence(text) if time_limited else text)
+    return answers
 
 
-@torch.inference_mode()
-def generate_reply(user_text: str, db=None) -> str: 
+# yields pieces of the answer while generate is still decoding.
+# Transformers streamers only work with greedy decoding, so a request that asks
+# for more beams gets its whole answer as a single piece at the end instead.
+def stream_job(job: dict, num_beams: int = STREAM_NUM_BEAMS):
+    remaining = _remaining(job, time.monotonic())
+    plan = plan_generation(remaining, 0, num_beams)
+    if plan is None or plan[0] > 1:
+        yield polish_batch([job], num_beams=num_beams)[0]
+        return
+    max_new_tokens = plan[1]
+    model, tok = get_llm()
+    with METRICS.time("chatbot_stage_seconds", stage="tokenize"):
+        inputs = _encode(tok, [job], model.device)
+    streamer = TextIteratorStreamer(tok, skip_prompt=True, skip_special_tokens=True)
+    cancel = CancelCriteria([job])
+
+    @torch.inference_mode()
+    def run():
+        # runs on its own thread, so the request's trace is handed over explicitly
+        with METRICS.trace(job.get("trace")):
+            try:
+                with METRICS.time("chatbot_stage_seconds", stage="generate"):
+                    model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False, num_beams=1,
+                                   repetition_penalty=2.5, streamer=streamer, max_time=remaining,
+                                   stopping_criteria=StoppingCriteriaList([cancel]))
+                if cancel.stopped:
+                    job["degraded"] = True
+                    GENERATION_STATS["cancelled_during_generation"] += 1
+                    METRICS.inc("chatbot_answers_total", outcome="cancelled")
+                else:
+                    METRICS.inc("chatbot_answers_total", outcome="answered")
+            except Exception:
+                # unblock the consumer, the error itself is logged by the thread
+                streamer.end()
+                raise
+
+    thread = threading.Thread(target=run, daemon=True)
+    started = time.perf_counter()
+    thread.start()
+    first = True
+    try:
+        for piece in streamer:
+            if piece:
+                if first:
+                    METRICS.observe("chatbot_stage_seconds", time.perf_counter() - started, stage="first_token")
+                    first = False
+                yield piece
+    finally:
+        thread.join()
+
+
+def stream_with_llm(question: str, context_text: str, num_beams: int = STREAM_NUM_BEAMS):
+    return stream_job({"question": question, "context": context_text}, num_beams)
+
+
+def polish_with_llm(question: str, context_text: str, stream: bool = False, num_beams: int = None):
+    if stream:
+        return stream_with_llm(question, context_text, num_beams or STREAM_NUM_BEAMS)
+    return polish_batch([{"question": question, "context": context_text}], num_beams=num_beams)[0]
+
+
+def _index_id(db) -> str:
+    # the index fingerprint changes with every ingest, which retires all older cache entries
+    return getattr(db, "ncdb_fingerprint", None) or f"id{id(db)}"
+
+
+def _cache_key(question: str, db) -> str:
+    return f"{_index_id(db)}|{normalize_question(question)}"
+
+
+def search_with_scores(db, query_vector, k: int = TOP_K):
+    # [(doc, cosine similarity)], best first. The embeddings are L2-normalized, so the squared
+    # L2 distance d that FAISS returns by default converts to cosine similarity as 1 - d / 2
+    hits = db.similarity_search_with_score_by_vector(query_vector, k=k)
+    strategy = getattr(getattr(db, "distance_strategy", None), "value", "EUCLIDEAN_DISTANCE")
+    if strategy in ("MAX_INNER_PRODUCT", "DOT_PRODUCT", "COSINE"):
+        return [(doc, float(score)) for doc, score in hits]
+    return [(doc, 1.0 - float(score) / 2) for doc, score in hits]
+
+
+def _row_similarity(db, row: int, query_vector, fallback: float) -> float:
+    # cosine similarity of a chunk the dense search did not return, from its stored vector.
+    # IVF indexes ingested without a direct map cannot give their vectors back; the chunk
+    # then scores no better than the weakest dense hit
+    try:
+        vector = db.index.reconstruct(int(row))
+    except RuntimeError:
+        return fallback
+    return float(np.dot(np.asarray(query_vector, dtype="float32"), vector))
+
+
+def hybrid_search(db, question: str, query_vector, k: int):
+    # [(doc, cosine similarity)] of the dense search fused with the BM25 index saved by
+    # ingest.py, best first. The fusion decides the order, the similarity stays the chunk's
+    # own, so the retrieval threshold still judges BM25 hits by their meaning
+    dense = search_with_scores(db, query_vector, k)
+    bm25 = getattr(db, "ncdb_bm25", None)
+    if bm25 is None or not question:
+        return dense
+    with METRICS.time("chatbot_stage_seconds", stage="lexical"):
+        lexical = bm25.search(question, k)
+    fused = {}
+    for rank, (doc, score) in enumerate(dense, start=1):
+        fused[id(doc)] = [1 / (HYBRID_RRF_K + rank), doc, score]
+    for rank, (row, _) in enumerate(lexical, start=1):
+        doc = db.docstore.search(db.index_to_docstore_id.get(row))
+        if not hasattr(doc, "page_content"):
+            continue
+        entry = fused.get(id(doc))
+        if entry is None:
+            weakest = min((score for _, score in dense), default=-1.0)
+            entry = fused[id(doc)] = [0.0, doc, _row_similarity(db, row, query_vector, weakest)]
+        entry[0] += 1 / (HYBRID_RRF_K + rank)
+    return [(doc, score) for _, doc, score in sorted(fused.values(), key=lambda entry: -entry[0])]
+
+
+def retrieval_score(scored) -> float:
+    # the best similarity among the chosen chunks
+    return max((score for _, score in scored), default=-1.0)
+
+
+def _matches(doc, where: dict) -> bool:
+    # where: {"model_families": "v16", "source_type": "csv", "year": 1933}. A list-valued
+    # field matches when it contains the value, "year" when it lies within the chunk's years
+    meta = doc.metadata
+    if "model_families" not in meta:
+        # indexes from before chunks were tagged
+        meta = dict(meta, **chunk_tags(doc.page_content, meta.get("source", "")))
+    for key, value in where.items():
+        if key == "year":
+            if meta.get("year_from") is None or not meta["year_from"] <= value <= meta["year_to"]:
+                return False
+        elif isinstance(meta.get(key), list):
+            if value not in meta[key]:
+                return False
+        elif meta.get(key) != value:
+            return False
+    return True
+
+
+def filtered_search(db, query_vector, k: int, where: dict, question: str = ""):
+    # [(doc, cosine similarity)] of the best k chunks matching `where`, fetching more
+    # neighbours until enough of them match (or SEARCH_MAX_FETCH were looked at).
+    # With the question, candidates come from the hybrid dense and BM25 ranking
+    total = min(db.index.ntotal, SEARCH_MAX_FETCH)
+    fetch = k * SEARCH_OVERFETCH
+    while total > 0:
+        fetch = min(fetch, total)
+        hits = [(doc, score) for doc, score in hybrid_search(db, question, query_vector, fetch) if _matches(doc, where)]
+        if len(hits) >= k or fetch >= total:
+            return hits[:k]
+        fetch *= SEARCH_OVERFETCH
+    return []
+
+
+def _search_filters(question: str) -> list:
+    # narrowest first: V16 chunks covering a year the question names, then any V16 chunk
+    filters = [{"model_families": "v16"}]
+    for year in sorted(set(years(question))):
+        if 1930 <= year <= 1940:
+            filters.insert(0, {"model_families": "v16", "year": year})
+            break
+    return filters
+
+
+def search_chunks(db, question: str, query_vector, k: int = CONTEXT_CHUNKS):
+    # the chunks for the prompt's context, with their scores, best first
+    scored = []
+    for where in _search_filters(question):
+        scored = filtered_search(db, query_vector, k, where, question)
+        if len(scored) >= k:
+            break
+    if not scored:
+        # nothing about the V16 near the question, answer from the nearest chunks
+        scored = hybrid_search(db, question, query_vector, k)[:k]
+    return scored
+
+
+def _embed_query(db, q: str):
+    # the FAISS store was loaded with embed_query itself, or with an embeddings object
+    fn = db.embedding_function
+    return fn.embed_query(q) if hasattr(fn, "embed_query") else fn(q)
+
+
+def remember_answer(job: dict, db, answer: str):
+    if job.get("degraded"):
+        return
+    ANSWER_CACHE.put(_cache_key(job["question"], db), answer)
+    SEMANTIC_CACHE.put(job["vector"], _index_id(db), answer, job["question"])
+
+
+# answers that need neither retrieval nor the model: greetings, off-domain questions and
+# exact cache hits, or None. Cheap enough for the server's event loop, which lets these
+# through even when the generation queue is full.
+def quick_reply(user_text: str, db=None):
     q = (user_text or "").strip()
 
     if is_greeting(q):
+        METRICS.inc("chatbot_answers_total", outcome="greeting")
         return "Hi! I'm the NCDB chatbot. I'm doing well, how can I help you today?"
 
     if not is_domain_question(q):
+        METRICS.inc("chatbot_answers_total", outcome="off_domain")
         return "Hi! I specialize in Cadillac V16 (1930-1940) questions. Feel free to ask about history, styles, or engines."
 
 
     if db is None:
+        METRICS.inc("chatbot_answers_total", outcome="no_index")
         return "Error: Knowledge base (FAISS) not loaded."
 
+    with METRICS.time("chatbot_stage_seconds", stage="answer_cache"):
+        cached = ANSWER_CACHE.get(_cache_key(q, db))
+    if cached is not None:
+        METRICS.inc("chatbot_answers_total", outcome="cached")
+    return cached
+
+
+# everything generate_reply does before the LLM call: intent checks, caches and retrieval.
+# Returns (answer, None) when no generation is needed, otherwise (None, job) where job is
+# a dict with the question, its packed encoder input IDs, the top chunk for an extractive fallback,
+# the query embedding and the deadline, so the socket server can hand it to its batching scheduler.
+def prepare_reply(user_text: str, db=None, deadline: float = None): 
+    answer = quick_reply(user_text, db)
+    if answer is not None:
+        return answer, None
+    return retrieve_job(user_text, db, deadline)
 
-    raw_hits = db.similarity_search(q, k=TOP_K)
-    
-    v16_hits = []
-    for doc in raw_hits:
-        content = doc.page_content.lower()
-        if "v16" in content or "v-16" in content or "sixteen" in content:
-            v16_hits.append(doc)
-            
-    final_hits = v16_hits[:2] if v16_hits else raw_hits[:2]
+
+# the part of prepare_reply after quick_reply: semantic cache, then retrieval
+@torch.inference_mode()
+def retrieve_job(user_text: str, db, deadline: float = None):
+    q = (user_text or "").strip()
+
+    with METRICS.time("chatbot_stage_seconds", stage="embed"):
+        query_vector = _embed_query(db, q)
+    with METRICS.time("chatbot_stage_seconds", stage="semantic_cache"):
+        cached = SEMANTIC_CACHE.get(query_vector, _index_id(db), q)
+    if cached is not None:
+        METRICS.inc("chatbot_answers_total", outcome="semantic_cached")
+        return cached, None
+
+    with METRICS.time("chatbot_stage_seconds", stage="search"):
+        scored = search_chunks(db, q, query_vector)
+    if scored and retrieval_score(scored) < RETRIEVAL_THRESHOLD:
+        # nothing in the index is close to the question, generation would only make something up
+        METRICS.inc("chatbot_answers_total", outcome="below_threshold")
+        return NOT_FOUND_ANSWER, None
+    final_hits = [doc for doc, _ in scored]
 
     if not final_hits:
-        return "I am sorry, I do not have enough information."
+        METRICS.inc("chatbot_answers_total", outcome="no_hits")
+        return NOT_FOUND_ANSWER, None
+
+    _, tok = get_llm()
+    with METRICS.time("chatbot_stage_seconds", stage="pack"):
+        input_ids = pack_prompt(tok, q, final_hits)
+    job = {
+        "question": q,
+        "input_ids": input_ids,
+        "top_chunk": _chunk_text(final_hits[0]),
+        "vector": query_vector,
+        "deadline": deadline,
+        # set by the server when the client disconnects, generation then stops early
+        "cancel": threading.Event(),
+        # the request's trace, so the batch that generates the answer can record into it
+        "trace": current_trace(),
+    }
+    return None, job
 
-    blocks = []
-    for doc in final_hits:
-        cleaned_content = clean_text(doc.page_content)
-        source = doc.metadata.get('source', 'Unknown Document')
-        blocks.append(f"[Source: {source}]: {cleaned_content[:MAX_CHARS_PER_CHUNK]}")
 
-    full_context = "\n\n".join(blocks)
-    return polish_with_llm(q, full_context)
+# deadline is a time.monotonic() value the answer has to be ready by
+def generate_reply(user_text: str, db=None, deadline: float = None) -> str: 
+    answer, job = prepare_reply(user_text, db, deadline)
+    if answer is not None:
+        return answer
+    answer = polish_batch([job])[0]
+    remember_answer(job, db, answer)
+    return answer
@@ -0,0 +1,216 @@
+# In-process metrics for the chatbot server: latency histograms per stage, counters by
+# outcome and gauges read at scrape time. Recording is a dictionary lookup and a few
+# additions under a lock, cheap next to an embedding or a generate call.
+#
+# get_llm_answer.py serves them in Prometheus text format on a local HTTP port and as a
+# JSON snapshot over the chat socket ({"type": "metrics"}).
+#
+# Inside METRICS.trace() the stage timings and the outcome of the current request are also
+# collected in a Trace, which the server writes to its query journal.
+import bisect
+import contextvars
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds; embedding and search land in the low buckets, beam search in the high ones
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        # upper bound of the bucket holding the q-th observation, like histogram_quantile;
+        # None when it lies beyond the last bucket
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "avg": round(self.sum / self.count, 4) if self.count else 0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Trace:
+    # what one request went through: seconds per stage and the outcome that answered it
+    __slots__ = ("stages", "route")
+
+    def __init__(self):
+        self.stages = {}
+        self.route = None
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def merge(self, other: "Trace"):
+        for stage, seconds in other.stages.items():
+            self.add(stage, seconds)
+
+
+_trace = contextvars.ContextVar("chatbot_trace", default=None)
+
+
+def current_trace():
+    # the Trace of the request being handled, or None outside METRICS.trace().
+    # Executor threads do not inherit it: run work there with contextvars.copy_context().run
+    return _trace.get()
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+        trace = _trace.get()
+        if trace is not None and "stage" in labels:
+            trace.add(labels["stage"], seconds)
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        trace = _trace.get()
+        if trace is not None and "outcome" in labels:
+            trace.route = labels["outcome"]
+
+    @contextmanager
+    def trace(self, trace: Trace = None):
+        # collects the stages and outcome recorded in this context (a new Trace, or the given one)
+        trace = trace or Trace()
+        token = _trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _trace.reset(token)
+
+    def gauge(self, name: str, read, help_text: str = ""):
+        # read() is called at scrape time, so nothing is recorded on the request path
+        self._gauges[name] = read
+        if help_text:
+            self.describe(name, help_text)
+
+    def _gauge_values(self):
+        values = {}
+        for name, read in list(self._gauges.items()):
+            try:
+                values[name] = read()
+            except Exception:
+                continue
+        return values
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            histograms, counters = {}, {}
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                histograms.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels) or "all"] = histogram.snapshot()
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels) or "all"] = value
+        return {"histograms": histograms, "counters": counters, "gauges": self._gauge_values()}
+
+    def prometheus(self) -> str:
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            last = None
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name != last:
+                    header(name, "histogram")
+                    last = name
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    le = _format_labels(labels, 'le="%s"' % bound)
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                le = _format_labels(labels, 'le="+Inf"')
+                lines.append(f"{name}_bucket{le} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            last = None
+            for (name, labels), value in sorted(self._counters.items()):
+                if name != last:
+                    header(name, "counter")
+                    last = name
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name, value in sorted(self._gauge_values().items()):
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# helpers for the offline measuring tools (benchmark.py, replay.py, bench_index.py, ...)
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+METRICS = Metrics()
+METRICS.describe("chatbot_stage_seconds", "Time spent in each stage of answering a question")
+METRICS.describe("chatbot_request_seconds", "Time from receiving a question to sending the answer")
+METRICS.describe("chatbot_queue_wait_seconds", "Time a job waited for its generate batch")
+METRICS.describe("chatbot_answers_total", "Questions answered, by how the answer was produced")
+METRICS.describe("chatbot_requests_total", "Socket requests, by type and result")
@@ -0,0 +1,215 @@
+# The heavy objects of the chatbot server live here: the flan-t5 model and tokenizer,
+# the MiniLM embeddings and the FAISS index. get_llm_answer.py and llm.py both go
+# through these getters, so every model is loaded exactly once per process.
+import hashlib
+import os
+import pickle
+import threading
+import time
+import torch
+from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+
+from bm25 import BM25_FILE, BM25Index
+
+LLM_MODEL = os.environ.get("LLM_MODEL", "google/flan-t5-base")
+EMBEDDING_MODEL_DIR = os.environ.get("EMBEDDING_MODEL_DIR", "embedding_model")
+INDEX_DIR = os.environ.get("FAISS_INDEX_DIR", "faiss_index")
+# how often get_index() looks for a re-ingested index on disk
+INDEX_CHECK_SECONDS = float(os.environ.get("FAISS_INDEX_CHECK_SECONDS", "30"))
+# memory-map index.faiss instead of reading it into private memory, so worker processes
+# (and reloads after a re-ingest) share the same page-cache pages
+FAISS_MMAP = os.environ.get("FAISS_MMAP", "1") == "1"
+# query-time settings of approximate indexes (FAISS_INDEX_TYPE at ingest): IVF clusters
+# searched and HNSW search breadth. More is slower and closer to exact; 0 keeps the FAISS
+# defaults (nprobe 1, efSearch 16). Flat indexes ignore both
+FAISS_NPROBE = int(os.environ.get("FAISS_NPROBE", "8"))
+FAISS_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "64"))
+# "int8" runs flan-t5 and MiniLM with int8 dynamically quantized Linear layers (CPU only)
+QUANTIZE = os.environ.get("LLM_QUANTIZE", "")
+# "torch" or "onnx" (ONNX Runtime graphs written by export_onnx.py, see onnx_backend.py);
+# "stub" swaps in the tiny offline stand-ins from stub_models.py, for benchmark.py
+BACKEND = os.environ.get("LLM_BACKEND", "torch")
+
+# the server calls the getters from several threads
+_LOCK = threading.RLock()
+_MODEL = None
+_TOKENIZER = None
+_EMBEDDINGS = None
+_INDEX = None
+_INDEX_LOADED = False
+_INDEX_FINGERPRINT = ""
+_INDEX_CHECKED_AT = 0.0
+
+
+def load_llm(quantize: bool = False, backend: str = "torch"):
+    if backend == "onnx":
+        from onnx_backend import load_onnx_llm
+        return load_onnx_llm()
+    if backend == "stub":
+        from stub_models import load_stub_llm
+        return load_stub_llm()
+    tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL)
+    if quantize:
+        from quantize import load_quantized
+        model = load_quantized(LLM_MODEL, lambda: AutoModelForSeq2SeqLM.from_pretrained(LLM_MODEL))
+        return model, tokenizer
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = AutoModelForSeq2SeqLM.from_pretrained(LLM_MODEL).to(device)
+    model.eval()
+    return model, tokenizer
+
+
+def get_llm():
+    global _MODEL, _TOKENIZER
+    if _MODEL is not None and _TOKENIZER is not None:
+        return _MODEL, _TOKENIZER
+    with _LOCK:
+        if _MODEL is None or _TOKENIZER is None:
+            _MODEL, _TOKENIZER = load_llm(quantize=QUANTIZE == "int8", backend=BACKEND)
+    return _MODEL, _TOKENIZER
+
+
+def get_embeddings():
+    global _EMBEDDINGS
+    if _EMBEDDINGS is not None:
+        return _EMBEDDINGS
+    with _LOCK:
+        if _EMBEDDINGS is None and BACKEND == "stub":
+            from stub_models import HashEmbeddings
+            _EMBEDDINGS = HashEmbeddings()
+        if _EMBEDDINGS is None:
+            # ingest pulls in the document loaders, only import it when the server needs it
+            from ingest import MiniLMSentenceEmbeddings
+            _EMBEDDINGS = MiniLMSentenceEmbeddings(EMBEDDING_MODEL_DIR, quantize=QUANTIZE == "int8", backend=BACKEND)
+    return _EMBEDDINGS
+
+
+def _embed_query(text: str):
+    # the index's query embedder, resolved on first use so loading an index loads no model
+    return get_embeddings().embed_query(text)
+
+
+def index_fingerprint(path: str = INDEX_DIR) -> str:
+    # changes whenever ingest.py rewrites the index files, "" when there is no index
+    if not os.path.isdir(path):
+        return ""
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(path)):
+        st = os.stat(os.path.join(path, name))
+        digest.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return digest.hexdigest()[:16]
+
+
+def _load_faiss(path: str):
+    # ingest.py writes bm25.pkl right after index.faiss; an older one belongs to the previous
+    # ingest, and its rows would point at the wrong chunks of the new index
+    bm25_path = os.path.join(path, BM25_FILE)
+    if os.path.exists(bm25_path) and os.path.getmtime(bm25_path) < os.path.getmtime(os.path.join(path, "index.faiss")):
+        raise RuntimeError(f"{BM25_FILE} is older than index.faiss, ingest.py is still writing")
+    # imported here like faiss itself, which only an index load needs
+    from vector_index import set_search_params
+    db = _read_faiss(path)
+    set_search_params(db.index, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH)
+    return db
+
+
+def _read_faiss(path: str):
+    from langchain_community.vectorstores import FAISS
+    if not FAISS_MMAP:
+        return FAISS.load_local(path, _embed_query, allow_dangerous_deserialization=True)
+    import faiss
+    # same files FAISS.load_local reads, but the vectors are mapped rather than copied;
+    # older faiss builds only know IO_FLAG_MMAP, which maps IVF lists but reads flat codes
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        index = faiss.read_index(os.path.join(path, "index.faiss"), flags)
+    except RuntimeError as e:
+        print(f"Warning: could not memory-map the FAISS index ({e}), reading it instead.")
+        index = faiss.read_index(os.path.join(path, "index.faiss"))
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(_embed_query, index, docstore, index_to_docstore_id)
+
+
+def get_index():
+    # returns None when ingest.py has not been run yet.
+    # The files are checked every INDEX_CHECK_SECONDS and a re-ingested index is loaded in
+    # place of the old one; callers still holding the old object can keep using it.
+    global _INDEX, _INDEX_LOADED, _INDEX_FINGERPRINT, _INDEX_CHECKED_AT
+    if _INDEX_LOADED and time.monotonic() - _INDEX_CHECKED_AT < INDEX_CHECK_SECONDS:
+        return _INDEX
+    with _LOCK:
+        if _INDEX_LOADED and time.monotonic() - _INDEX_CHECKED_AT < INDEX_CHECK_SECONDS:
+            return _INDEX
+        _INDEX_CHECKED_AT = time.monotonic()
+        fingerprint = index_fingerprint()
+        if _INDEX_LOADED and fingerprint == _INDEX_FINGERPRINT:
+            return _INDEX
+        if fingerprint:
+            #  loading local pickle based FAISS files
+            try:
+                db = _load_faiss(INDEX_DIR)
+            except Exception as e:
+                # most likely ingest.py is still writing the files, try again on the next check
+                print(f"Warning: could not load FAISS index: {e}")
+                # on a first load the server starts without an index until the next check
+                _INDEX_LOADED = True
+                return _INDEX
+            # caches key their entries on this, so answers from an old index are never reused
+            db.ncdb_fingerprint = fingerprint
+            # the lexical side of hybrid retrieval, None for indexes ingested before it existed
+            db.ncdb_bm25 = BM25Index.load(INDEX_DIR)
+            from vector_index import describe
+            print(f"FAISS index loaded successfully ({fingerprint}, {describe(db.index)}).")
+        else:
+            db = None
+            print("Warning: No FAISS index found. Run ingest.py first.")
+        _INDEX, _INDEX_FINGERPRINT, _INDEX_LOADED = db, fingerprint, True
+    return _INDEX
+
+
+def current_index():
+    # the index as last loaded, without looking at the files: for the server's event loop,
+    # where a reload (reading index.faiss, unpickling the docstore) would block every
+    # connection. watch_index() keeps it current
+    return _INDEX
+
+
+def watch_index():
+    # checks for a re-ingested index every INDEX_CHECK_SECONDS on a background thread;
+    # started per process because threads do not survive the server forking its workers
+    def run():
+        while True:
+            time.sleep(INDEX_CHECK_SECONDS)
+            try:
+                get_index()
+            except Exception as e:
+                print(f"Warning: could not check the FAISS index: {e}")
+    threading.Thread(target=run, daemon=True, name="index-watch").start()
+
+
+def load_models():
+    # load without running anything, the pre-fork server calls this before forking workers.
+    # ONNX Runtime sessions start their thread pools when they are created, and those do not
+    # survive a fork; with the onnx backend every worker creates its own sessions after
+    # setup_worker has sized its threads, and only the index is shared
+    if BACKEND != "onnx":
+        get_llm()
+        get_embeddings()
+    get_index()
+
+
+@torch.inference_mode()
+def warm_up():
+    # load everything and push one dummy question through embedding, search and generate,
+    # so the first real visitor sees steady-state latency instead of lazy loading
+    model, tok = get_llm()
+    embeddings = get_embeddings()
+    db = get_index()
+    embeddings.embed_query("Cadillac V16 warm up")
+    if db is not None:
+        db.similarity_search("Cadillac V16 warm up", k=1)
+    inputs = tok(["Question: warm up"], return_tensors="pt").to(model.device)
+    model.generate(**inputs, max_new_tokens=4, num_beams=4)
+    print(f"Models warmed up ({LLM_MODEL}, {EMBEDDING_MODEL_DIR}, {BACKEND}"
+          f"{', int8' if QUANTIZE == 'int8' and BACKEND == 'torch' else ''}).")
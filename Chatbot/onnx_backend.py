@@ -0,0 +1,39 @@
+# ONNX Runtime backend, selected with LLM_BACKEND=onnx.
+# export_onnx.py writes the graphs once, offline: the MiniLM encoder, and the flan-t5
+# encoder plus a decoder that takes past key/values so every generated token only runs
+# the new position. The optimum ORT models keep the transformers interface (generate,
+# streamers, outputs[0]), so llm.py and MiniLMSentenceEmbeddings use them unchanged.
+import os
+
+ONNX_DIR = os.environ.get("ONNX_DIR", "onnx_models")
+ONNX_LLM_DIR = os.path.join(ONNX_DIR, "llm")
+ONNX_EMBEDDING_DIR = os.path.join(ONNX_DIR, "embeddings")
+
+
+def _session_options():
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # follow the torch thread setting so pre-forked workers do not oversubscribe the cores
+    import torch
+    options.intra_op_num_threads = torch.get_num_threads()
+    return options
+
+
+def _require(path: str):
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"No ONNX export in {path}. Run export_onnx.py first.")
+
+
+def load_onnx_llm(path: str = ONNX_LLM_DIR):
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    from transformers import AutoTokenizer
+    _require(path)
+    model = ORTModelForSeq2SeqLM.from_pretrained(path, use_cache=True, session_options=_session_options())
+    return model, AutoTokenizer.from_pretrained(path)
+
+
+def load_onnx_encoder(path: str = ONNX_EMBEDDING_DIR):
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    _require(path)
+    return ORTModelForFeatureExtraction.from_pretrained(path, session_options=_session_options())
@@ -0,0 +1,668 @@
+# Wire protocol between the Django views and the get_llm_answer.py socket server.
+# This file has to be the same on both sides: it lives next to get_llm_answer.py in
+# NCDBContent/Chatbot/ and a copy goes next to views.py in CadillacDBProj/Chatbot/.
+#
+# Every message is one frame:
+#   MAGIC (4 bytes) | header length (uint32) | body length (uint32) | JSON header | UTF-8 body
+# The header says what the frame is ({"type": "ask", "id": 1}) and the body carries the
+# question or the answer text, so neither side needs a fixed recv() buffer size.
+# A connection can carry any number of request/response pairs.
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+import weakref
+
+# starts with a NUL byte so it can never be confused with a plain-text question
+# sent by an old client that still writes the raw query to the socket
+MAGIC = b"\x00NCB"
+_PREFIX = struct.Struct("!4sII")
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 4 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ServerError(Exception):
+    # the server answered with an "error" frame
+    pass
+
+
+class ServerBusy(Exception):
+    # the server turned the question away because its queue is full
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def check_reply(header: dict, body: str):
+    # raises for "error" and "busy" frames
+    kind = header.get("type")
+    if kind == "error":
+        raise ServerError(header.get("error", "unknown error"))
+    if kind == "busy":
+        raise ServerBusy(body or header.get("reason", "server busy"), header.get("retry_after"))
+
+
+class PoolTimeout(Exception):
+    # every client of a ClientPool stayed busy for the whole timeout
+    pass
+
+
+class CircuitOpen(Exception):
+    # the server failed repeatedly, requests fail at once without contacting it
+    pass
+
+
+# the server could not be reached or did not answer in time, as opposed to a
+# ServerError where it answered and said the question failed
+TRANSPORT_ERRORS = (OSError, ProtocolError, asyncio.TimeoutError, asyncio.IncompleteReadError)
+# the request never got an answer, the question itself is not to blame
+UNAVAILABLE_ERRORS = TRANSPORT_ERRORS + (CircuitOpen, PoolTimeout)
+
+
+def encode_frame(header: dict, body: str = "") -> bytes:
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    body_bytes = (body or "").encode("utf-8")
+    if len(header_bytes) > MAX_HEADER_BYTES or len(body_bytes) > MAX_BODY_BYTES:
+        raise ProtocolError("Frame too large")
+    return _PREFIX.pack(MAGIC, len(header_bytes), len(body_bytes)) + header_bytes + body_bytes
+
+
+def _parse_prefix(prefix: bytes):
+    magic, header_len, body_len = _PREFIX.unpack(prefix)
+    if magic != MAGIC:
+        raise ProtocolError("Bad frame magic")
+    if header_len > MAX_HEADER_BYTES or body_len > MAX_BODY_BYTES:
+        raise ProtocolError("Frame too large")
+    return header_len, body_len
+
+
+def _decode(header_bytes: bytes, body_bytes: bytes):
+    try:
+        header = json.loads(header_bytes.decode("utf-8"))
+    except ValueError as e:
+        raise ProtocolError(f"Bad frame header: {e}")
+    if not isinstance(header, dict):
+        raise ProtocolError("Frame header must be a JSON object")
+    return header, body_bytes.decode("utf-8")
+
+
+def parse_address(value):
+    # "unix:/run/ncdb/chatbot.sock" or an absolute path selects the AF_UNIX transport,
+    # anything else is treated as "host:port" (or an existing (host, port) tuple)
+    if isinstance(value, (tuple, list)):
+        return socket.AF_INET, (value[0], int(value[1]))
+    if value.startswith("unix:"):
+        return socket.AF_UNIX, value[len("unix:"):]
+    if value.startswith("/"):
+        return socket.AF_UNIX, value
+    host, _, port = value.rpartition(":")
+    return socket.AF_INET, (host or "localhost", int(port))
+
+
+# blocking helpers, used by the Django side
+
+def recv_exact(sock, n: int) -> bytes:
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 65536))
+        if not chunk:
+            raise ConnectionError("Connection closed mid-frame")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_frame(sock, header: dict, body: str = ""):
+    sock.sendall(encode_frame(header, body))
+
+
+def recv_frame(sock):
+    # returns (header, body), or None when the peer closed the connection between frames
+    first = sock.recv(_PREFIX.size)
+    if not first:
+        return None
+    prefix = first + recv_exact(sock, _PREFIX.size - len(first))
+    header_len, body_len = _parse_prefix(prefix)
+    return _decode(recv_exact(sock, header_len), recv_exact(sock, body_len))
+
+
+def connect(address, timeout: float = 20):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(addr)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+# asyncio helpers, used by the socket server
+
+async def read_frame(reader, head: bytes = b""):
+    # head holds prefix bytes the caller already consumed (the server peeks at the magic
+    # to tell framed clients from old raw-text clients)
+    try:
+        prefix = head + await reader.readexactly(_PREFIX.size - len(head))
+    except asyncio.IncompleteReadError as e:
+        if not e.partial and not head:
+            return None
+        raise
+    header_len, body_len = _parse_prefix(prefix)
+    header_bytes = await reader.readexactly(header_len)
+    body_bytes = await reader.readexactly(body_len)
+    return _decode(header_bytes, body_bytes)
+
+
+async def write_frame(writer, header: dict, body: str = ""):
+    writer.write(encode_frame(header, body))
+    await writer.drain()
+
+
+async def open_connection(address):
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        return await asyncio.open_unix_connection(addr)
+    return await asyncio.open_connection(*addr)
+
+
+class ChatClient:
+    """Blocking client that keeps one connection open across requests."""
+
+    def __init__(self, address, timeout: float = 20):
+        self.address = address
+        self.timeout = timeout
+        self._sock = None
+        self._ids = itertools.count(1)
+        self.connects = 0
+        # reentrant so ask_stream can hold it across request() and the frames that follow
+        self._lock = threading.RLock()
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+
+    def request(self, header: dict, body: str = ""):
+        header = dict(header, id=next(self._ids))
+        with self._lock:
+            # a kept-alive connection may have been closed by a server restart,
+            # in that case reconnect once and resend (questions are safe to repeat)
+            for attempt in range(2):
+                reused = self._sock is not None
+                if not reused:
+                    self._sock = connect(self.address, self.timeout)
+                    self.connects += 1
+                try:
+                    send_frame(self._sock, header, body)
+                    frame = recv_frame(self._sock)
+                    if frame is None:
+                        raise ConnectionError("Server closed the connection")
+                except socket.timeout:
+                    # the server is alive but slow, resending would only double the wait
+                    self.close()
+                    raise
+                except (ConnectionError, ProtocolError, OSError):
+                    self.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                return frame
+
+    def ping(self):
+        # one round trip, raises if the server cannot be reached
+        self.request({"type": "ping"})
+
+    def stats(self) -> dict:
+        header, body = self.request({"type": "stats"})
+        check_reply(header, body)
+        return json.loads(body)
+
+    def metrics(self) -> dict:
+        header, body = self.request({"type": "metrics"})
+        check_reply(header, body)
+        return json.loads(body)
+
+    def ask(self, query: str, **fields) -> str:
+        # the server plans its generation to finish within our timeout
+        header, body = self.request(dict({"timeout": self.timeout}, **fields, type="ask"), query)
+        check_reply(header, body)
+        return body
+
+    def ask_stream(self, query: str, **fields):
+        # yields ("token", text) while the answer is decoded, then ("end", final_answer);
+        # the final answer is what the server settled on and may differ from the joined tokens
+        with self._lock:
+            header, body = self.request(dict({"timeout": self.timeout}, **fields, type="ask", stream=True), query)
+            finished = False
+            try:
+                while True:
+                    kind = header.get("type")
+                    if kind in ("error", "busy"):
+                        finished = True
+                        check_reply(header, body)
+                    if kind == "end":
+                        finished = True
+                        yield "end", body
+                        return
+                    yield "token", body
+                    frame = recv_frame(self._sock)
+                    if frame is None:
+                        raise ConnectionError("Server closed the connection")
+                    header, body = frame
+            finally:
+                # frames left unread would be taken as the answer to the next question
+                if not finished:
+                    self.close()
+
+
+class CircuitBreaker:
+    """Stops sending requests to a server that keeps failing.
+
+    Closed, every request goes through. After `failures` transport errors in a row it
+    opens, and requests fail at once with CircuitOpen instead of each waiting for its own
+    connect or recv timeout. After `reset_after` seconds one caller becomes the probe
+    (half-open): the pool pings the server, and the breaker closes if it answers or
+    opens again for another `reset_after` if it does not.
+    """
+
+    def __init__(self, failures: int = 3, reset_after: float = 10):
+        self.failures = max(1, failures)
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+        self.opened = 0
+        self.short_circuited = 0
+        self.probes = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if self._probing else "open"
+
+    def before_call(self) -> bool:
+        # True when this caller is the probe, raises CircuitOpen while the breaker is open
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if not self._probing and time.monotonic() - self._opened_at >= self.reset_after:
+                self._probing = True
+                self.probes += 1
+                return True
+            self.short_circuited += 1
+        raise CircuitOpen("Chatbot server is unavailable")
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.warning("Chatbot server answers again, circuit closed")
+            self._consecutive = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._probing or (self._opened_at is None and self._consecutive >= self.failures):
+                if self._opened_at is None:
+                    self.opened += 1
+                    logger.warning(f"Chatbot server failed {self._consecutive} times in a row, circuit opened")
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self._consecutive,
+                "opened": self.opened,
+                "short_circuited": self.short_circuited,
+                "probes": self.probes,
+            }
+
+
+class ClientPool:
+    """Thread-safe pool of kept-alive ChatClients shared by every thread of a Django worker.
+
+    size caps the requests this process has in flight to the model server at once; a
+    thread that finds every client busy waits up to timeout seconds and then gets
+    PoolTimeout. Connections idle for more than health_check_after seconds are pinged
+    before they are used again. All requests go through a CircuitBreaker, whose probe
+    is a ping with probe_timeout.
+    """
+
+    def __init__(self, address, size: int = 4, timeout: float = 20, health_check_after: float = 30,
+                 breaker: CircuitBreaker = None, probe_timeout: float = 2):
+        self.address = address
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.breaker = breaker or CircuitBreaker()
+        self.probe_timeout = probe_timeout
+        self._clients = [ChatClient(address, timeout) for _ in range(self.size)]
+        # (client, last used) pairs, the most recently used one is taken first so it is warm
+        self._idle = [(client, 0.0) for client in self._clients]
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.waited = 0
+        self.rejected = 0
+        self.errors = 0
+        self.health_checks = 0
+        self.failed_health_checks = 0
+        self.total_wait = 0.0
+
+    def _acquire(self) -> ChatClient:
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waited += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.rejected += 1
+                raise PoolTimeout(f"All {self.size} connections to the chatbot server are busy")
+        with self._lock:
+            self.requests += 1
+            self.total_wait += time.monotonic() - started
+            client, last_used = self._idle.pop()
+        if client._sock is not None and time.monotonic() - last_used > self.health_check_after:
+            self._check(client)
+        return client
+
+    def _check(self, client: ChatClient):
+        # ping reconnects by itself if the server restarted while the connection sat idle;
+        # if that fails too the connection is dropped and the request tries a fresh one
+        with self._lock:
+            self.health_checks += 1
+        try:
+            client.ping()
+        except Exception:
+            with self._lock:
+                self.failed_health_checks += 1
+            client.close()
+
+    def _release(self, client: ChatClient):
+        with self._lock:
+            self._idle.append((client, time.monotonic()))
+        self._slots.release()
+
+    def _probe(self):
+        # a throwaway connection with a short timeout, so a hung server fails the probe quickly
+        probe = ChatClient(self.address, self.probe_timeout)
+        try:
+            probe.ping()
+        except Exception:
+            self.breaker.record_failure()
+            raise CircuitOpen("Chatbot server is still unavailable")
+        finally:
+            probe.close()
+        self.breaker.record_success()
+
+    @contextlib.contextmanager
+    def client(self):
+        if self.breaker.before_call():
+            self._probe()
+        client = self._acquire()
+        try:
+            yield client
+        except ServerBusy:
+            # the server is up, it only has no room for this question
+            self.breaker.record_success()
+            raise
+        except TRANSPORT_ERRORS:
+            with self._lock:
+                self.errors += 1
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            self._release(client)
+
+    def ask(self, query: str, **fields) -> str:
+        with self.client() as client:
+            return client.ask(query, **fields)
+
+    def ask_stream(self, query: str, **fields):
+        # the client stays taken until the stream is finished or abandoned
+        with self.client() as client:
+            yield from client.ask_stream(query, **fields)
+
+    def server_stats(self) -> dict:
+        with self.client() as client:
+            return client.stats()
+
+    def close(self):
+        with self._lock:
+            for client, _ in self._idle:
+                client.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = len(self._idle)
+            connected = sum(client._sock is not None for client, _ in self._idle)
+            return {
+                "size": self.size,
+                "in_use": self.size - idle,
+                "idle_connected": connected,
+                "connects": sum(client.connects for client in self._clients),
+                "requests": self.requests,
+                "waited": self.waited,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "health_checks": self.health_checks,
+                "failed_health_checks": self.failed_health_checks,
+                "avg_wait_ms": round(1000 * self.total_wait / self.requests, 2) if self.requests else 0,
+                "breaker": self.breaker.stats(),
+            }
+
+
+# asyncio clients, used by the async Django views
+
+class AsyncChatClient:
+    """asyncio counterpart of ChatClient, one kept-alive connection."""
+
+    def __init__(self, address, timeout: float = 20):
+        self.address = address
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._ids = itertools.count(1)
+        self.connects = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    def close(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except RuntimeError:
+                # the event loop it belonged to is already closed
+                pass
+            finally:
+                self._reader = self._writer = None
+
+    async def request(self, header: dict, body: str = ""):
+        header = dict(header, id=next(self._ids))
+        # same reconnect-once rule as ChatClient.request
+        for attempt in range(2):
+            reused = self._writer is not None
+            try:
+                if not reused:
+                    self._reader, self._writer = await asyncio.wait_for(open_connection(self.address), self.timeout)
+                    self.connects += 1
+                await write_frame(self._writer, header, body)
+                frame = await asyncio.wait_for(read_frame(self._reader), self.timeout)
+                if frame is None:
+                    raise ConnectionError("Server closed the connection")
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                # an answer may still arrive on this connection, it must not be read as the next one
+                self.close()
+                raise
+            except (ConnectionError, ProtocolError, OSError, asyncio.IncompleteReadError):
+                self.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            return frame
+
+    async def ping(self):
+        await self.request({"type": "ping"})
+
+    async def stats(self) -> dict:
+        header, body = await self.request({"type": "stats"})
+        check_reply(header, body)
+        return json.loads(body)
+
+    async def ask(self, query: str, **fields) -> str:
+        header, body = await self.request(dict({"timeout": self.timeout}, **fields, type="ask"), query)
+        check_reply(header, body)
+        return body
+
+
+class AsyncClientPool:
+    """asyncio counterpart of ClientPool, for async views served by an ASGI server.
+
+    Connections belong to the event loop that opened them, so every loop that uses the
+    pool gets its own set of size clients (under ASGI that is one loop per process).
+    The breaker can be shared with a ClientPool talking to the same server.
+    """
+
+    def __init__(self, address, size: int = 4, timeout: float = 20, health_check_after: float = 30,
+                 breaker: CircuitBreaker = None, probe_timeout: float = 2):
+        self.address = address
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.breaker = breaker or CircuitBreaker()
+        self.probe_timeout = probe_timeout
+        self._loops = weakref.WeakKeyDictionary()
+        self.requests = 0
+        self.waited = 0
+        self.rejected = 0
+        self.errors = 0
+        self.health_checks = 0
+        self.failed_health_checks = 0
+        self.total_wait = 0.0
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            clients = [AsyncChatClient(self.address, self.timeout) for _ in range(self.size)]
+            # clients, (client, last used) pairs with the warmest last, and the free slots
+            state = self._loops[loop] = (clients, [(client, 0.0) for client in clients], asyncio.Semaphore(self.size))
+        return state
+
+    async def _acquire(self):
+        _, idle, slots = state = self._state()
+        started = time.monotonic()
+        if not slots.locked():
+            # a free slot is taken without suspending, so the check above cannot go stale
+            await slots.acquire()
+        else:
+            self.waited += 1
+            try:
+                await asyncio.wait_for(slots.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise PoolTimeout(f"All {self.size} connections to the chatbot server are busy")
+        self.requests += 1
+        self.total_wait += time.monotonic() - started
+        client, last_used = idle.pop()
+        if client.connected and time.monotonic() - last_used > self.health_check_after:
+            self.health_checks += 1
+            try:
+                await client.ping()
+            except Exception:
+                self.failed_health_checks += 1
+                client.close()
+        return state, client
+
+    async def _probe(self):
+        probe = AsyncChatClient(self.address, self.probe_timeout)
+        try:
+            await probe.ping()
+        except asyncio.CancelledError:
+            # the probe has to end either way, or no caller would ever probe again
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise CircuitOpen("Chatbot server is still unavailable")
+        finally:
+            probe.close()
+        self.breaker.record_success()
+
+    @contextlib.asynccontextmanager
+    async def client(self):
+        if self.breaker.before_call():
+            await self._probe()
+        (_, idle, slots), client = await self._acquire()
+        try:
+            yield client
+        except ServerBusy:
+            # the server is up, it only has no room for this question
+            self.breaker.record_success()
+            raise
+        except TRANSPORT_ERRORS:
+            self.errors += 1
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            idle.append((client, time.monotonic()))
+            slots.release()
+
+    async def ask(self, query: str, **fields) -> str:
+        async with self.client() as client:
+            return await client.ask(query, **fields)
+
+    async def server_stats(self) -> dict:
+        async with self.client() as client:
+            return await client.stats()
+
+    def stats(self) -> dict:
+        states = list(self._loops.values())
+        return {
+            "size": self.size,
+            "loops": len(states),
+            "in_use": sum(self.size - len(idle) for _, idle, _ in states),
+            "idle_connected": sum(client.connected for _, idle, _ in states for client, _ in idle),
+            "connects": sum(client.connects for clients, _, _ in states for client in clients),
+            "requests": self.requests,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "health_checks": self.health_checks,
+            "failed_health_checks": self.failed_health_checks,
+            "avg_wait_ms": round(1000 * self.total_wait / self.requests, 2) if self.requests else 0,
+            "breaker": self.breaker.stats(),
+        }
@@ -0,0 +1,50 @@
+# Int8 dynamic quantization for CPU inference.
+# The Linear layers of flan-t5 and MiniLM get int8 weights, activations are quantized on
+# the fly. Converting takes a while, so the quantized modules are saved under
+# QUANTIZED_DIR and loaded from there on the next start.
+import hashlib
+import os
+import re
+import torch
+
+QUANTIZED_DIR = os.environ.get("QUANTIZED_DIR", "quantized_models")
+
+
+def quantize_dynamic_int8(model):
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+
+def _cache_path(name: str) -> str:
+    # a local model directory that changes (a new embedding_model) must not reuse an old file,
+    # and pickled quantized modules are only safe to load with the torch and transformers that
+    # wrote them: the pickle holds transformers' model classes, whose layout changes between versions
+    import transformers
+    source = name
+    if os.path.isdir(name):
+        digest = hashlib.sha1()
+        for root, _, files in sorted(os.walk(name)):
+            for file_name in sorted(files):
+                st = os.stat(os.path.join(root, file_name))
+                digest.update(f"{file_name}:{st.st_size}:{st.st_mtime_ns};".encode())
+        source = f"{os.path.basename(os.path.normpath(name))}-{digest.hexdigest()[:10]}"
+    safe_name = re.sub(r"[^\w.-]", "_", source)
+    versions = f"torch{torch.__version__}-transformers{transformers.__version__}"
+    return os.path.join(QUANTIZED_DIR, f"{safe_name}-int8-{versions}.pt")
+
+
+def load_quantized(name: str, load_fp32):
+    # load_fp32 is only called when there is no cached quantized copy yet
+    path = _cache_path(name)
+    if os.path.exists(path):
+        model = torch.load(path, weights_only=False)
+        model.eval()
+        return model
+    model = quantize_dynamic_int8(load_fp32())
+    os.makedirs(QUANTIZED_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    print(f"Saved int8 copy of {name} to {path}")
+    return model
@@ -0,0 +1,42 @@
+# Question sets for the measuring tools (benchmark.py, compare_quantization.py,
+# calibrate_threshold.py, bench_index.py): a built-in set, and the files they read.
+import json
+
+# what visitors ask about the V16
+DOMAIN_QUESTIONS = [
+    "How many Cadillac V16 cars survive?",
+    "Which coachbuilder built most V16 bodies?",
+    "When was the Cadillac V16 engine introduced?",
+    "What body styles did Fleetwood offer on the V16 chassis?",
+    "How many V16 cars were built in 1930?",
+    "What was the displacement of the 1938 V16 engine?",
+    "Was the V16 town car built by Fisher or Fleetwood?",
+    "What is the difference between the 1930 and 1938 V16 engines?",
+    "What wheelbase did the V16 chassis have?",
+    "When did Cadillac stop building the V16?",
+    "What is a Madame X V16?",
+    "How many V16 cars were made in 1933?",
+    "How much horsepower did the first V16 engine make?",
+    "Did the V16 have overhead valves?",
+]
+# with a greeting and an off-domain question, like real traffic
+QUESTIONS = DOMAIN_QUESTIONS + [
+    "hello",
+    "What is the weather today?",
+]
+
+
+def read_records(path: str) -> list:
+    # a JSON list, or JSON lines (a query journal, for one)
+    with open(path) as f:
+        text = f.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def read_questions(path: str) -> list:
+    # plain strings, {"question": ...} or query journal entries (journal.py), which keep it under "q"
+    questions = [r.get("question") or r.get("q") if isinstance(r, dict) else r for r in read_records(path)]
+    return [q for q in questions if q]
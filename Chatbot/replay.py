@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# Replays a query journal (see journal.py) against a running chatbot server and reports
+# latency and error distributions.
+#
+#   python replay.py query_journal.jsonl*                    # original timing
+#   python replay.py query_journal.jsonl --speed 4           # four times as fast
+#   python replay.py query_journal.jsonl --speed max --concurrency 16
+#   python replay.py query_journal.jsonl --address unix:/run/ncdb/chatbot.sock --out replay.json
+#
+# Questions are sent at their journal times divided by --speed (open loop: a slow server
+# does not slow the schedule down, the requests pile up like real visitors would), or all
+# at once with --speed max, limited only by --concurrency. Streaming questions are replayed
+# as streaming questions. Requests the server turned away in the journal are sent again.
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from journal import read_journal
+from metrics import percentile
+from protocol import CircuitBreaker, CircuitOpen, ClientPool, PoolTimeout, ServerBusy, ServerError, TRANSPORT_ERRORS
+
+
+def summarize(latencies) -> dict:
+    ms = sorted(1000 * x for x in latencies)
+    if not ms:
+        return {"count": 0}
+    return {
+        "count": len(ms),
+        "mean": round(sum(ms) / len(ms), 1),
+        "p50": round(percentile(ms, 50), 1),
+        "p95": round(percentile(ms, 95), 1),
+        "p99": round(percentile(ms, 99), 1),
+        "max": round(ms[-1], 1),
+    }
+
+
+def classify(e: Exception) -> str:
+    if isinstance(e, ServerBusy):
+        return "busy"
+    if isinstance(e, (PoolTimeout, CircuitOpen)):
+        return "unavailable"
+    if isinstance(e, ServerError):
+        return "server_error"
+    if isinstance(e, TimeoutError):
+        return "timeout"
+    if isinstance(e, TRANSPORT_ERRORS):
+        return "transport"
+    return type(e).__name__
+
+
+def replay(entries, pool: ClientPool, speed, concurrency: int) -> dict:
+    lock = threading.Lock()
+    latencies = []
+    by_route = defaultdict(list)
+    errors = Counter()
+    lag = []
+
+    def send(entry, due):
+        sent = time.perf_counter()
+        if due is not None:
+            lag.append(sent - due)
+        try:
+            if entry.get("kind") == "stream":
+                for _ in pool.ask_stream(entry["q"]):
+                    pass
+            else:
+                pool.ask(entry["q"])
+        except Exception as e:
+            with lock:
+                errors[classify(e)] += 1
+            return
+        elapsed = time.perf_counter() - sent
+        with lock:
+            latencies.append(elapsed)
+            by_route[entry.get("route") or "unknown"].append(elapsed)
+
+    first_ts = entries[0].get("ts", 0) if entries else 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for entry in entries:
+            due = None
+            if speed != "max":
+                due = started + (entry.get("ts", first_ts) - first_ts) / speed
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            executor.submit(send, entry, due)
+    wall = time.perf_counter() - started
+
+    return {
+        "requests": len(entries),
+        "answered": len(latencies),
+        "errors": dict(errors),
+        "error_rate": round(sum(errors.values()) / len(entries), 4) if entries else 0,
+        "wall_seconds": round(wall, 2),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0,
+        "latency_ms": summarize(latencies),
+        # latency by the route the journal recorded for the original request
+        "latency_ms_by_route": {route: summarize(values) for route, values in sorted(by_route.items())},
+        # how late requests were sent against the schedule; large values mean the replay
+        # itself could not keep up (raise --concurrency)
+        "send_lag_ms": summarize(lag) if lag else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a query journal against a chatbot server")
+    parser.add_argument("journal", nargs="+", help="journal files, rotated ones included")
+    parser.add_argument("--address", default="localhost:12345", help="host:port or unix:/path of the server")
+    parser.add_argument("--speed", default="1", help="1 = original timing, 2 = twice as fast, max = no pauses")
+    parser.add_argument("--concurrency", type=int, default=32, help="most requests outstanding at once")
+    parser.add_argument("--timeout", type=float, default=20, help="client timeout per request")
+    parser.add_argument("--kinds", default="ask,stream,legacy", help="request kinds to replay")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N questions")
+    parser.add_argument("--out", help="write the report as JSON")
+    args = parser.parse_args()
+
+    speed = "max" if args.speed == "max" else float(args.speed)
+    if speed != "max" and speed <= 0:
+        parser.error("--speed must be positive or max")
+    kinds = set(args.kinds.split(","))
+    entries = [e for e in read_journal(args.journal) if e.get("q") and e.get("kind") in kinds]
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        print("No questions to replay.")
+        sys.exit(1)
+    span = entries[-1].get("ts", 0) - entries[0].get("ts", 0)
+    print(f"Replaying {len(entries)} questions spanning {span:.0f} s against {args.address} at speed {args.speed}")
+
+    # a breaker that never opens: after a few timeouts the default one fails requests at once
+    # for a while, and the report would describe the client instead of the server
+    pool = ClientPool(args.address, size=args.concurrency, timeout=args.timeout,
+                      breaker=CircuitBreaker(failures=10 ** 9))
+    try:
+        report = replay(entries, pool, speed, args.concurrency)
+    finally:
+        pool.close()
+    report["config"] = {"address": args.address, "speed": args.speed, "concurrency": args.concurrency,
+                        "journal": args.journal}
+
+    lat = report["latency_ms"]
+    print(f"{report['answered']} answered in {report['wall_seconds']} s ({report['throughput_rps']} req/s), "
+          f"error rate {report['error_rate']:.1%} {report['errors'] or ''}")
+    if lat["count"]:
+        print(f"latency p50 {lat['p50']} ms p95 {lat['p95']} ms p99 {lat['p99']} ms max {lat['max']} ms")
+    for route, s in report["latency_ms_by_route"].items():
+        print(f"  {route:16s} {s['count']:6d}  p50 {s['p50']:8.1f} ms  p95 {s['p95']:8.1f} ms")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
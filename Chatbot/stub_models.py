@@ -0,0 +1,113 @@
+# Stand-in models for LLM_BACKEND=stub, used by benchmark.py to run offline on any CPU.
+# The "LLM" is a tiny randomly initialised T5 with a hashing word tokenizer, so generate,
+# beam search, streaming and stopping criteria all run the real transformers code, just
+# with much less arithmetic than flan-t5. The embeddings hash words into a fixed-size
+# vector, so questions that share words land close together in the FAISS index.
+# Answers are nonsense words; only the timings mean anything.
+import math
+import os
+import re
+import zlib
+
+import torch
+from transformers import BatchEncoding, T5Config, T5ForConditionalGeneration
+
+VOCAB_SIZE = 2048
+EMBEDDING_DIM = 384
+PAD_ID, EOS_ID = 0, 1
+
+FIXTURE_DOCS = [
+    "The Cadillac V-16 was introduced in January 1930 as the first production sixteen-cylinder car in America.",
+    "The 1930 V-16 engine displaced 452 cubic inches and produced 165 horsepower.",
+    "Fleetwood built most V16 bodies, including town cars, limousines and all-weather phaetons.",
+    "Fisher built a small number of V16 bodies in the first model year.",
+    "The 1938 Series 90 V16 used a new 431 cubic inch L-head engine with a 135 degree vee.",
+    "Fewer than 4,400 Cadillac V16 cars were built between 1930 and 1940.",
+    "The V16 engine used overhead valves with hydraulic silencers in its first series.",
+    "Most 1930 V16 cars were delivered with Fleetwood bodies built in Pennsylvania.",
+    "The Cadillac V16 chassis had a 148 inch wheelbase until 1933 and 154 inches later.",
+    "Production of the V16 ended in 1940 when the Series 90 was discontinued.",
+    "The Madame X style was a Fleetwood design with thin pillars and a sloping windshield.",
+    "The 1933 V16 was limited to 400 cars, each built to order.",
+    "V16 cars were sold with a choice of over fifty Fleetwood body styles in 1930.",
+    "The Cadillac V12 was introduced later in 1930 as a less expensive multi-cylinder car.",
+    "Surviving V16 cars are tracked by the registry with engine numbers and body numbers.",
+    "The 1934 V16 used a new streamlined Fleetwood body with skirted fenders.",
+]
+
+
+class HashTokenizer:
+    # just enough of the transformers tokenizer interface for llm.py and the streamer
+    pad_token_id = PAD_ID
+    eos_token_id = EOS_ID
+    vocab_size = VOCAB_SIZE
+
+    def _ids(self, text: str, add_special_tokens: bool = True):
+        words = re.findall(r"\w+|[^\w\s]", text.lower())
+        ids = [2 + zlib.crc32(w.encode()) % (VOCAB_SIZE - 2) for w in words]
+        return ids + [EOS_ID] if add_special_tokens else ids
+
+    def __call__(self, texts, return_tensors=None, padding=False, truncation=False, max_length=None,
+                 add_special_tokens=True, **kwargs):
+        single = isinstance(texts, str)
+        ids = [self._ids(t, add_special_tokens) for t in ([texts] if single else texts)]
+        if truncation and max_length:
+            ids = [i[:max_length] for i in ids]
+        if return_tensors is None:
+            return BatchEncoding({"input_ids": ids[0] if single else ids})
+        width = max(len(i) for i in ids)
+        return BatchEncoding({
+            "input_ids": torch.tensor([i + [PAD_ID] * (width - len(i)) for i in ids]),
+            "attention_mask": torch.tensor([[1] * len(i) + [0] * (width - len(i)) for i in ids]),
+        })
+
+    def decode(self, ids, skip_special_tokens=True, **kwargs) -> str:
+        if hasattr(ids, "tolist"):
+            ids = ids.tolist()
+        return " ".join(f"w{i}" for i in ids if not (skip_special_tokens and i < 2))
+
+    def batch_decode(self, sequences, skip_special_tokens=True, **kwargs):
+        return [self.decode(s, skip_special_tokens=skip_special_tokens) for s in sequences]
+
+
+def load_stub_llm():
+    # seeded, so every run (and every benchmark process) gets the same weights
+    torch.manual_seed(0)
+    config = T5Config(vocab_size=VOCAB_SIZE, d_model=64, d_ff=128, d_kv=16, num_heads=4, num_layers=2,
+                      num_decoder_layers=2, pad_token_id=PAD_ID, eos_token_id=EOS_ID,
+                      decoder_start_token_id=PAD_ID)
+    model = T5ForConditionalGeneration(config)
+    model.eval()
+    return model, HashTokenizer()
+
+
+class HashEmbeddings:
+    def embed_query(self, text: str):
+        vector = [0.0] * EMBEDDING_DIM
+        for word in re.findall(r"\w+", text.lower()):
+            h = zlib.crc32(word.encode())
+            vector[h % EMBEDDING_DIM] += 1.0 if h & 0x80000000 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+
+def build_fixture_index(path: str, copies: int = 8):
+    # a small FAISS index in the layout ingest.py writes; every fact appears in a few
+    # variants so searches have near-duplicates to rank, like the real chunked corpus
+    from langchain.docstore.document import Document
+    from langchain_community.vectorstores import FAISS
+    from bm25 import BM25Index
+    from chunks import prepare_chunks
+    docs = []
+    for n in range(copies):
+        for i, text in enumerate(FIXTURE_DOCS):
+            docs.append(Document(page_content=text if n == 0 else f"{text} (registry note {n})",
+                                 metadata={"source": f"fixture_{i}.txt"}))
+    db = FAISS.from_documents(prepare_chunks(docs, HashTokenizer()), HashEmbeddings())
+    os.makedirs(path, exist_ok=True)
+    db.save_local(path)
+    BM25Index.build([doc.page_content for doc in docs]).save(path)
+    return path
@@ -0,0 +1,93 @@
+# FAISS index types for the chunk vectors. "flat" is the exact search FAISS.from_documents
+# always built; its cost grows linearly with the number of chunks. The approximate types
+# trade a little recall for much less work per query on a large corpus:
+#   hnsw      graph search, no training, efSearch sets the breadth of the search
+#   ivf_flat  vectors split into nlist clusters trained on a sample, nprobe clusters searched
+#   ivf_pq    like ivf_flat, with vectors compressed by product quantization (much smaller)
+# All use L2 distance on the normalized embeddings, so llm.search_with_scores converts
+# their distances to cosine similarity the same way. bench_index.py compares them.
+import math
+import uuid
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+# k-means wants at least this many training vectors per cluster
+MIN_POINTS_PER_CENTROID = 39
+
+
+def default_nlist(n: int) -> int:
+    # about 4 * sqrt(n) clusters, as few as the training sample can support
+    return max(1, min(int(4 * math.sqrt(n)), n // MIN_POINTS_PER_CENTROID))
+
+
+def _pq_subquantizers(dim: int, wanted: int) -> int:
+    # the number of sub-vectors has to divide the dimension
+    return max(m for m in range(1, min(wanted, dim) + 1) if dim % m == 0)
+
+
+def build_index(vectors, index_type: str = "flat", nlist: int = 0, hnsw_m: int = 32, pq_m: int = 16,
+                pq_bits: int = 8, train_sample: int = 50000, seed: int = 0):
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, dim = vectors.shape
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = nlist or default_nlist(n)
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            # each codebook needs enough training vectors too; small corpora get smaller codebooks
+            while pq_bits > 4 and n < MIN_POINTS_PER_CENTROID * 2 ** pq_bits:
+                pq_bits -= 1
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_subquantizers(dim, pq_m), pq_bits)
+        sample = vectors
+        if n > train_sample:
+            sample = vectors[np.random.default_rng(seed).choice(n, train_sample, replace=False)]
+        index.train(sample)
+    else:
+        raise ValueError(f"unknown index type {index_type!r}, expected one of {', '.join(INDEX_TYPES)}")
+    index.add(vectors)
+    if index_type.startswith("ivf"):
+        # lets llm.py look up the vector of a chunk BM25 found, to score it
+        index.make_direct_map()
+    return index
+
+
+def set_search_params(index, nprobe: int = 0, ef_search: int = 0):
+    # the query-time knobs: clusters searched by IVF indexes, search breadth of HNSW.
+    # 0 keeps the FAISS default (nprobe 1, efSearch 16)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if hasattr(index, "hnsw") and ef_search:
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def describe(index) -> str:
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        kind = "ivf_pq" if isinstance(ivf, faiss.IndexIVFPQ) else "ivf_flat"
+        return f"{kind} (nlist {ivf.nlist}, nprobe {ivf.nprobe})"
+    if hasattr(index, "hnsw"):
+        return f"hnsw (efSearch {index.hnsw.efSearch})"
+    return "flat"
+
+
+def index_bytes(index) -> int:
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def make_store(docs, embeddings, index_type: str = "flat", **params):
+    # FAISS.from_documents, but with the chosen index type
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+    index = build_index(np.asarray(vectors, dtype="float32"), index_type, **params)
+    ids = [str(uuid.uuid4()) for _ in docs]
+    return FAISS(embeddings, index, InMemoryDocstore(dict(zip(ids, docs))), dict(enumerate(ids)))
@@ -1,5 +1,5 @@
 from django.shortcuts import render, HttpResponse
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
@@ -10,9 +10,10 @@ import logging
 import hashlib
 from pathlib import Path
 import subprocess
-import socket
 from django.http import HttpResponse
 from EB.views import run_email_script
+from asgiref.sync import sync_to_async
+from Chatbot.protocol import AsyncClientPool, CircuitBreaker, ClientPool, ServerBusy, UNAVAILABLE_ERRORS
 
 import time
 import os
@@ -23,11 +24,35 @@ import os
 logger = logging.getLogger(__name__)
 
 DEFAULT_RESPONSE = 'I am sorry, I do not understand. Please contact mrcadillac@newcadillacdatabase.org for further assistance.'
+# shown while the model server is down or restarting; unlike "I do not know." it does not
+# log the question as unanswered, the server never saw it
+UNAVAILABLE_RESPONSE = 'The chatbot is temporarily unavailable. Please try again in a few minutes.'
+# shown when the model server turns the question away because too many are waiting, not logged either
+BUSY_RESPONSE = 'The chatbot is answering many questions right now. Please try again in a minute.'
 
 CHATBOT_QUESTIONS_URL_ROOT = settings.CHATBOT_QUESTIONS_URL_ROOT
 questions_without_answer_path = os.path.join(CHATBOT_QUESTIONS_URL_ROOT, "questions_without_answer.json")
 questions_with_answers_path = os.path.join(CHATBOT_QUESTIONS_URL_ROOT, "questions_with_answers.json")
 
+# set CHATBOT_SERVER_SOCKET to the server's CHATBOT_SOCKET path to use the unix socket
+# instead of TCP, both processes run on the same host
+CHATBOT_SERVER_ADDRESS = getattr(settings, "CHATBOT_SERVER_SOCKET", "") or (
+    getattr(settings, "CHATBOT_SERVER_HOST", "localhost"), getattr(settings, "CHATBOT_SERVER_PORT", 12345))
+# Added a 20 second timeout to prevent the website from freezing
+CHATBOT_SERVER_TIMEOUT = getattr(settings, "CHATBOT_SERVER_TIMEOUT", 20)
+# kept-alive connections shared by all threads of this Django worker, so questions skip the
+# TCP handshake; it is also the most questions this worker sends to the model server at once
+CHATBOT_POOL_SIZE = getattr(settings, "CHATBOT_POOL_SIZE", 4)
+# after this many failed requests in a row the chatbot answers UNAVAILABLE_RESPONSE at once,
+# and checks every CHATBOT_BREAKER_RESET seconds whether the server is back
+llm_breaker = CircuitBreaker(failures=getattr(settings, "CHATBOT_BREAKER_FAILURES", 3),
+                             reset_after=getattr(settings, "CHATBOT_BREAKER_RESET", 10))
+llm_pool = ClientPool(CHATBOT_SERVER_ADDRESS, size=CHATBOT_POOL_SIZE, timeout=CHATBOT_SERVER_TIMEOUT,
+                      breaker=llm_breaker)
+# the same for chat_async, its connections live on the ASGI event loop
+async_llm_pool = AsyncClientPool(CHATBOT_SERVER_ADDRESS, size=CHATBOT_POOL_SIZE, timeout=CHATBOT_SERVER_TIMEOUT,
+                                 breaker=llm_breaker)
+
 # Added a try except block to avoid django app crash on startup. Now it defaults to an empty list.
 try:
     with open(questions_with_answers_path, "r", encoding="utf-8") as saved_questions_file:
@@ -35,6 +60,10 @@ try:
 except Exception as e:
     logger.error(f"Failed to load shortcut QA file: {e}")
     shortcut_qa = []
+# lowercased question -> answer; the first entry wins, like the old linear search
+shortcut_answers = {}
+for item in shortcut_qa:
+    shortcut_answers.setdefault(item['question'].lower(), item['answer'])
 
 def chat_page(request):
     """ Chatbot demo page """
@@ -81,44 +110,63 @@ def add_unanswered_question(question):
         json.dump(questions_without_answer, json_file)
 
 def generate_answer_from_llm(query):
-     # Now it sends the query to a get_llm_answer.py via Sockets.
-    HOST = '0.0.0.0'
-    PORT = 12345
-    
+    # Now it sends the query to a get_llm_answer.py via Sockets.
     # this get response through socket from get_llm_answer.py in NCDBContent/Chatbot
     # Here is using socket because embedding models, embedding database and LLM
     # should only load once after getting new knowledge, instead of loading
     # each time if each user ask a question
     # Running get_llm_answer.py without using socket will add a lot of time & resources
     # for loading embedding models, embedding database and LLM each time
+    # Questions and answers are sent as length-prefixed frames (see protocol.py),
+    # so long questions and long answers are no longer cut off at a fixed buffer size.
 
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            # Added a 20 second timeout to prevent the website from freezing 
-            s.settimeout(20) 
-            s.connect((HOST, PORT))
-            s.sendall(query.encode('utf-8'))
-            # Increased buffer size to 4096
-            response = s.recv(4096).decode('utf-8')
-            return response
+        return llm_pool.ask(query)
+    except ServerBusy as e:
+        logger.info(f"Chatbot Service Busy: {e}")
+        return BUSY_RESPONSE
+    except UNAVAILABLE_ERRORS as e:
+        logger.warning(f"Chatbot Service Unavailable: {e}")
+        return UNAVAILABLE_RESPONSE
     except Exception as e:
         # Added error logging
         logger.error(f"Chatbot Service Error: {e}")
         return "I do not know."
 
+def find_shortcut_answer(query):
+    """Answer saved by the admin for exactly this question, or None"""
+    return shortcut_answers.get(query.lower())
+
+async def generate_answer_from_llm_async(query):
+    # same as generate_answer_from_llm, but waits on the event loop instead of holding a thread
+    try:
+        return await async_llm_pool.ask(query)
+    except ServerBusy as e:
+        logger.info(f"Chatbot Service Busy: {e}")
+        return BUSY_RESPONSE
+    except UNAVAILABLE_ERRORS as e:
+        logger.warning(f"Chatbot Service Unavailable: {e}")
+        return UNAVAILABLE_RESPONSE
+    except Exception as e:
+        logger.error(f"Chatbot Service Error: {e}")
+        return "I do not know."
+
+def chat_response(response_str):
+    resp_data = {
+        "status": True,
+        "data": response_str
+    }
+    # ensure the browser interprets the response as JSON.
+    return HttpResponse(json.dumps(resp_data), content_type="application/json")
+
 def chat(request):
     query = request.GET.get("query")
     # Added validation to handle empty requests gracefully.
     if not query:
         return JsonResponse({"status": False, "data": "No query provided."})
 
-    response_str = None
-
     # look for an answer first
-    for item in shortcut_qa:
-        if item['question'].lower() == query.lower():
-            response_str = item['answer']
-            break
+    response_str = find_shortcut_answer(query)
     
     # if no answer then use LLM socket service
     if response_str is None:
@@ -131,12 +179,93 @@ def chat(request):
         else:
             response_str = answer_generated_from_llm                
 
-    resp_data = {
-        "status": True,
-        "data": response_str
-    }
-    # ensure the browser interprets the response as JSON.
-    return HttpResponse(json.dumps(resp_data), content_type="application/json")
+    return chat_response(response_str)
+
+async def chat_async(request):
+    """Same as chat, for ASGI deployments.
+
+    While the model server works on the answer no Django worker thread is held, so slow
+    questions cannot starve the other pages of the site.
+    """
+    query = request.GET.get("query")
+    if not query:
+        return JsonResponse({"status": False, "data": "No query provided."})
+
+    response_str = find_shortcut_answer(query)
+    if response_str is None:
+        answer_generated_from_llm = await generate_answer_from_llm_async(query)
+        if answer_generated_from_llm == "I do not know." or not answer_generated_from_llm:
+            response_str = DEFAULT_RESPONSE
+            # file writes (and sometimes an email) run off the event loop, one at a time
+            # so two visitors cannot overwrite each other's question
+            await sync_to_async(add_unanswered_question, thread_sensitive=True)(query)
+        else:
+            response_str = answer_generated_from_llm
+
+    return chat_response(response_str)
+
+
+def sse_event(event, data):
+    """Format one server-sent event, data is JSON encoded so newlines survive"""
+    return f"event: {event}\ndata: {json.dumps({'data': data})}\n\n"
+
+def chat_stream(request):
+    """Same as chat, but streams the answer as server-sent events.
+
+    Sends "token" events while the model is still decoding and one "end" event
+    carrying the final answer, which the page should show in place of the tokens.
+    """
+    query = request.GET.get("query")
+    if not query:
+        return JsonResponse({"status": False, "data": "No query provided."})
+    # greedy decoding streams token by token, more beams give better answers but arrive at once
+    try:
+        num_beams = int(request.GET.get("num_beams", 1))
+    except ValueError:
+        num_beams = 1
+
+    def events():
+        shortcut = find_shortcut_answer(query)
+        if shortcut is not None:
+            yield sse_event("end", shortcut)
+            return
+        final = None
+        try:
+            for kind, text in llm_pool.ask_stream(query, num_beams=num_beams):
+                if kind == "token":
+                    yield sse_event("token", text)
+                else:
+                    final = text
+        except ServerBusy as e:
+            logger.info(f"Chatbot Service Busy: {e}")
+            final = BUSY_RESPONSE
+        except UNAVAILABLE_ERRORS as e:
+            logger.warning(f"Chatbot Service Unavailable: {e}")
+            final = UNAVAILABLE_RESPONSE
+        except Exception as e:
+            logger.error(f"Chatbot Service Error: {e}")
+        if final == "I do not know." or not final:
+            final = DEFAULT_RESPONSE
+            add_unanswered_question(query)
+        yield sse_event("end", final)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # stop nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@staff_member_required
+def llm_pool_stats(request):
+    """Connection pool statistics of this Django worker, ?server=1 adds the model server's own"""
+    data = {"pid": os.getpid(), "pool": llm_pool.stats(), "async_pool": async_llm_pool.stats()}
+    if request.GET.get("server"):
+        try:
+            data["server"] = llm_pool.server_stats()
+        except Exception as e:
+            data["server"] = {"error": str(e)}
+    return JsonResponse(data)
 
 
 @staff_member_required